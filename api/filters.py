@@ -4,7 +4,7 @@ from functools import reduce
 from django.db.models import Q
 from django_filters import rest_framework as filters
 
-from hub.models import Post, Tag, Attribute, TagSnapshot
+from hub.models import Post, Tag, Attribute, TagSnapshot, AttributeRegistry
 
 
 class NumArrayFilter(filters.BaseCSVFilter, filters.NumberFilter):
@@ -34,7 +34,7 @@ class TagFilter(filters.FilterSet):
 
     def search_by_name(self, queryset, name, value):
         fields = ['name', 'override_name'] + ['_detail__{}'.format(attr.code) for attr in
-                                              Attribute.objects.filter(code__startswith='name')]
+                                              AttributeRegistry.filter(prefix='name')]
         orm_lookups = ['{}__icontains'.format(field) for field in fields]
         or_queries = [Q(**{orm_lookup: value})
                       for orm_lookup in orm_lookups]
@@ -3,7 +3,7 @@ from rest_framework.serializers import raise_errors_on_nested_writes
 from rest_framework.utils import model_meta
 
 from bot.models import Weibo
-from hub.models import Post, Tag, Attribute, TagSnapshot
+from hub.models import Post, Tag, Attribute, TagSnapshot, AttributeRegistry
 from hub.validators import TagDetailValidator
 
 
@@ -25,8 +25,7 @@ class ModifyTagSerializer(serializers.ModelSerializer):
     detail = serializers.JSONField()
 
     def validate_detail(self, value):
-        return TagDetailValidator(
-            attributes=Attribute.objects.filter(related_types__contains=[self.instance.type]))(value)
+        return TagDetailValidator(attributes=AttributeRegistry.filter(type=self.instance.type))(value)
 
     def update(self, instance, validated_data):
         raise_errors_on_nested_writes('update', self, validated_data)
@@ -58,7 +57,9 @@ class DetailTagSerializer(serializers.ModelSerializer):
     def get_detail(self, obj):
         info_list = list()
         for key in obj.order_of_keys:
-            attr = Attribute.objects.get(code=key)
+            attr = AttributeRegistry.get(key)
+            if attr is None:  # removed attribute
+                continue
             info_list.append(
                 {
                     'attribute': BasicAttributeSerializer(attr).data,
@@ -95,7 +96,9 @@ class DetailTagSnapshotSerializer(serializers.ModelSerializer):
     def get_content(self, obj):
         info_list = list()
         for key, value in obj.content.items():
-            attr = Attribute.objects.get(code=key)
+            attr = AttributeRegistry.get(key)
+            if attr is None:  # removed attribute
+                continue
             info_list.append(
                 {
                     'attribute': BasicAttributeSerializer(attr).data,
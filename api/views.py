@@ -29,7 +29,7 @@ class TagSnapshotViewSet(viewsets.ReadOnlyModelViewSet):
     """
     Tag History
     """
-    queryset = TagSnapshot.objects.order_by('-update_time')
+    queryset = TagSnapshot.objects.select_related('_user').order_by('-update_time')
     filterset_class = filters.TagSnapshotFilter
 
     def get_serializer_class(self):
@@ -45,7 +45,7 @@ class TagViewSet(mixins.ListModelMixin,
     """
     Tag Information
     """
-    queryset = Tag.objects.exclude(deletion_flag=True)
+    queryset = Tag.objects.exclude(deletion_flag=True).select_related('latest_snapshot___user')
     serializer_class = serializers.BasicTagSerializer
     permission_classes = [permissions.EditableOrReadOnly, IsAuthenticatedOrReadOnly]
     filterset_class = filters.TagFilter
@@ -1,5 +1,6 @@
 from django.conf import settings
 from django.db import models
+from django.utils import timezone
 
 from bot.constants import WEIBO_BASE, BASE_62_KEYS
 from bot.services.utils.weiboV2 import rsa_encrypt, LOGIN_KEY, calculate_s
@@ -74,3 +75,104 @@ class Credential(models.Model):
         return {'uid': self.uid,
                 'aid': self.aid,
                 'gsid': self.gsid}
+
+
+class PostPage(models.Model):
+    """
+    first and last post id of a sakugabooru posts page, used to locate a post without searching.
+    """
+    limit = models.PositiveSmallIntegerField()
+    page = models.PositiveIntegerField()
+    first_id = models.IntegerField()
+    last_id = models.IntegerField()
+    update_time = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('limit', 'page')
+
+
+class SyncState(models.Model):
+    """
+    persistent state of sakugabooru sync jobs, such as checkpoints.
+    """
+    name = models.CharField(max_length=64, primary_key=True)
+    data = models.JSONField(default=dict, blank=True)
+    update_time = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def get_data(cls, name):
+        try:
+            return cls.objects.get(name=name).data
+        except cls.DoesNotExist:
+            return dict()
+
+    @classmethod
+    def set_data(cls, name, data):
+        cls.objects.update_or_create(name=name, defaults={'data': data})
+
+
+class BooruTag(models.Model):
+    """
+    local mirror of the tag table of sakugabooru.
+    """
+    id = models.IntegerField(primary_key=True)
+    name = models.CharField(max_length=255, db_index=True)
+    type = models.SmallIntegerField(default=0)
+    count = models.IntegerField(default=0)
+
+
+class ResponseCache(models.Model):
+    """
+    cached http responses of info services.
+    """
+    key = models.CharField(max_length=32, primary_key=True)
+    provider = models.CharField(max_length=64, db_index=True)
+    url = models.TextField()
+    status_code = models.PositiveSmallIntegerField()
+    headers = models.JSONField(default=dict, blank=True)
+    content = models.BinaryField()
+    expire_time = models.DateTimeField(db_index=True)
+    update_time = models.DateTimeField(auto_now=True)
+
+    @property
+    def is_expired(self):
+        return self.expire_time <= timezone.now()
+
+
+class RateLimitBucket(models.Model):
+    """
+    token bucket of a remote host, shared by all workers.
+    """
+    host = models.CharField(max_length=255, primary_key=True)
+    tokens = models.FloatField(default=0)
+    update_time = models.DateTimeField(default=timezone.now)
+
+
+class TagInfoProgress(models.Model):
+    """
+    tags done by a bulk tag info update, they are skipped when the update is resumed.
+    """
+    run = models.CharField(max_length=64)
+    tag = models.ForeignKey('hub.Tag', on_delete=models.CASCADE)
+    update_time = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('run', 'tag')
+
+
+class TagInfoState(models.Model):
+    """
+    last time and result of getting info of a tag from a provider.
+    last_time is null if the provider has never answered without an error,
+    failed providers are retried after retry_time, backing off with the count of failures in a row.
+    """
+    tag = models.ForeignKey('hub.Tag', on_delete=models.CASCADE)
+    provider = models.CharField(max_length=64)
+    found = models.BooleanField(default=False)
+    last_time = models.DateTimeField(default=timezone.now, null=True, db_index=True)
+    last_attempt = models.DateTimeField(default=timezone.now, db_index=True)
+    failures = models.PositiveSmallIntegerField(default=0)
+    retry_time = models.DateTimeField(default=None, null=True, blank=True)
+
+    class Meta:
+        unique_together = ('tag', 'provider')
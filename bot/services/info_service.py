@@ -1,20 +1,38 @@
+import asyncio
 import collections
-import difflib
+import copy
+import functools
 import html
+import inspect
+import json
 import logging
+import random
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from urllib import parse
 
 import regex
 import requests
-from bs4 import BeautifulSoup
 from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from lxml import etree
+from requests.structures import CaseInsensitiveDict
 from retrying import retry
 
 from bot.constants import ATWIKI_SEARCH_URI, ANIMEWIKI_URL_PATTERN, SAKUGAWIKI_URL_PATTERN, ASDB_SEARCH_URI, \
-    SYNONYM_DICT, ANN_URL, ANN_SEARCH_ENDPOINT, ANN_PEOPLE_ENDPOINT, MAL_URL, MAL_SEARCH_ENDPOINT, MAL_ANIME_ENDPOINT, \
+    ANN_URL, ANN_SEARCH_ENDPOINT, ANN_PEOPLE_ENDPOINT, MAL_URL, MAL_SEARCH_ENDPOINT, MAL_ANIME_ENDPOINT, \
     BANGUMI_API_URL, BANGUMI_SEARCH_ENDPOINT, BANGUMI_SUBJECT_ENDPOINT, GOOGLE_KGS_URL, GOOGLE_KGS_SEARCH_ENDPOINT, \
     GOOGLE_KGS_ENTITY_URI
+from bot.models import ResponseCache
+from bot.services.utils.cache import LRUCache
 from bot.services.utils.decorators import default_if_exception, retry_if_network_error_or_parse_error
+from bot.services.utils.normalize import normalize, remove_ja_name_space
+from bot.services.utils.ratelimit import TokenBucketRateLimiter
+from bot.services.utils.scraper import parse_html, has_class, get_text
+from bot.services.utils.session import get_session
+from hub.fields import hash_it
 
 logger = logging.getLogger('bot.services.info')
 
@@ -28,10 +46,19 @@ class InfoServiceBase(object):
 
     ENTITY_PK_NAME = ""
     ENTITY_NAME_KEYS = ()
+    PROVIDES = ()
 
     MIN_RATIO = 0.95
     CONTAIN_WEIGHT = 0.3
     CONTAIN_WEIGHT_REVERSED = 0.5
+    MAX_ITEM_WEIGHT = 0
+
+    CACHE_TTL = 60 * 60 * 24 * 7
+    NEGATIVE_CACHE_TTL = 60 * 60 * 24
+    CACHED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+
+    REQUESTS_PER_SECOND = 1
+    BURST = 5
 
     HEADERS = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
@@ -39,19 +66,111 @@ class InfoServiceBase(object):
     }
 
     def __init__(self):
-        self.session = requests.session()
-        self.session.headers.update(self.HEADERS)
+        self.session = get_session(self.BASE_URL, self.HEADERS, pool_maxsize=settings.INFO_SERVICE_MAX_WORKERS)
+        self.matcher = import_string(settings.INFO_SERVICE_MATCHER)
 
     @property
     def search_url(self):
         return '{}{}'.format(self.BASE_URL, self.SEARCH_ENDPOINT)
 
     def _get(self, url, **kwargs):
+        """
+        responses are cached by provider, url and params,
+        expired ones are revalidated with ETag/Last-Modified if the site supports it.
+        """
         kwargs.setdefault('timeout', 10)
-        response = self.session.get(url, **kwargs)
+        if not settings.INFO_SERVICE_CACHE:
+            response = self._request(url, **kwargs)
+            response.raise_for_status()
+            return response
+
+        key = self._get_cache_key(url, kwargs.get('params', None))
+        cache = ResponseCache.objects.filter(key=key).first()
+        if cache and not cache.is_expired:
+            logger.debug("Response of Url[{}] got from cache of {}.".format(url, self.NAME))
+            return self._get_cached_response(cache)
+
+        if cache:
+            kwargs['headers'] = dict(kwargs.get('headers', None) or dict(), **self._get_conditional_headers(cache))
+        response = self._request(url, **kwargs)
+        if cache and response.status_code == 304:
+            logger.debug("Cached response of Url[{}] revalidated by {}.".format(url, self.NAME))
+            cache.expire_time = self._get_expire_time(cache.status_code)
+            cache.save(update_fields=['expire_time', 'update_time'])
+            return self._get_cached_response(cache)
+        if response.ok or response.status_code == 404:
+            self._save_cached_response(key, response)
+        response.raise_for_status()
+        response.cache_key = key
+        return response
+
+    def _request(self, url, **kwargs):
+        if settings.INFO_SERVICE_RATE_LIMIT:
+            TokenBucketRateLimiter(parse.urlparse(url).netloc, self.REQUESTS_PER_SECOND, self.BURST).acquire()
+        return self.session.get(url, **kwargs)
+
+    def _get_cache_key(self, url, params):
+        return hash_it(json.dumps([self.NAME, url, params], sort_keys=True, default=str))
+
+    def _get_expire_time(self, status_code):
+        return timezone.now() + timedelta(seconds=self.CACHE_TTL if status_code < 400 else self.NEGATIVE_CACHE_TTL)
+
+    @staticmethod
+    def _get_conditional_headers(cache):
+        headers = dict()
+        if cache.headers.get('ETag', None):
+            headers['If-None-Match'] = cache.headers['ETag']
+        if cache.headers.get('Last-Modified', None):
+            headers['If-Modified-Since'] = cache.headers['Last-Modified']
+        return headers
+
+    def _save_cached_response(self, key, response):
+        headers = {k: response.headers[k] for k in self.CACHED_HEADERS if k in response.headers}
+        headers['encoding'] = response.encoding
+        ResponseCache.objects.update_or_create(key=key, defaults={
+            'provider': self.NAME,
+            'url': parse.urlsplit(response.url)._replace(query='').geturl(),  # params may hold api keys
+            'status_code': response.status_code,
+            'headers': headers,
+            'content': response.content,
+            'expire_time': self._get_expire_time(response.status_code)
+        })
+
+    @staticmethod
+    def _get_cached_response(cache):
+        response = requests.models.Response()
+        response.status_code = cache.status_code
+        response.url = cache.url
+        response.headers = CaseInsensitiveDict({k: v for k, v in cache.headers.items() if k != 'encoding'})
+        response.encoding = cache.headers.get('encoding', None)
+        response._content = bytes(cache.content)
+        response.cache_key = cache.key
         response.raise_for_status()
         return response
 
+    @staticmethod
+    def _set_negative_cache(response, ttl):
+        """
+        shorten the ttl of a cached response which has no results.
+        """
+        key = getattr(response, 'cache_key', None)
+        if key:
+            expire_time = timezone.now() + timedelta(seconds=ttl)
+            ResponseCache.objects.filter(key=key, expire_time__gt=expire_time).update(expire_time=expire_time)
+
+    @staticmethod
+    def _parse_response(response, parser):
+        """
+        drop the cached response if it can not be parsed, so that retrying gets it from remote.
+        """
+        try:
+            return parser(response)
+        except:
+            key = getattr(response, 'cache_key', None)
+            if key:
+                ResponseCache.objects.filter(key=key).delete()
+            raise
+
     def _get_search_requests_params(self, name):
         return self.search_url, {"params": {'q': name}}
 
@@ -69,20 +188,16 @@ class InfoServiceBase(object):
     def _get_entity_pk_from_info_dict(self, info_dict):
         return info_dict.get(self.ENTITY_PK_NAME, None)
 
-    @staticmethod
-    def _replace_synonym(name):
-        for k, v in SYNONYM_DICT.items():
-            if k in name:
-                name = name.replace(k, v)
-        return name
+    def _get_min_diff_ratio(self):
+        """
+        :return: the lowest matcher ratio that can still reach MIN_RATIO with the weights added
+        """
+        return self.MIN_RATIO - max(self.CONTAIN_WEIGHT, self.CONTAIN_WEIGHT_REVERSED, 0) - self.MAX_ITEM_WEIGHT
 
     def _get_diff_ratio(self, original, target):
-        process_str = lambda x: "".join(InfoServiceBase._replace_synonym(x).lower().split()) if x else ""
-        original = process_str(original)
-        target = process_str(target)
-        ratio = difflib.SequenceMatcher(None,
-                                        original,
-                                        target).ratio()
+        original = normalize(original)
+        target = normalize(target)
+        ratio = self.matcher(original, target, cutoff=self._get_min_diff_ratio())
         if ratio == 1:
             ratio = 2
         elif original in target:
@@ -97,7 +212,10 @@ class InfoServiceBase(object):
     def _get_search_results(self, name):
         response = self._get_search_response(name)
         logger.info('Name[{}] got search response from {}.'.format(name, self.NAME))
-        return self._generate_search_results(response)
+        results = self._parse_response(response, self._generate_search_results)
+        if not results:
+            self._set_negative_cache(response, self.NEGATIVE_CACHE_TTL)
+        return results
 
     @default_if_exception(default=list(),
                           logger=logger,
@@ -113,6 +231,20 @@ class InfoServiceBase(object):
             results.update(collections.OrderedDict([(self._get_entity_pk_from_info_dict(x), x) for x in item_list]))
         return list(results.values())
 
+    def _prepare_names(self, *names, **kwargs):
+        """
+        hook to clean names and apply options of get_info before searching
+        :return: tuple of names
+        """
+        return names
+
+    def _get_known_info(self):
+        """
+        hook to get info without searching, called after _prepare_names
+        :return: info dict, empty if unknown
+        """
+        return dict()
+
     def _get_names_from_info_dict(self, info_dict):
         return [value for key, value in info_dict.items() if key in self.ENTITY_NAME_KEYS]
 
@@ -157,11 +289,15 @@ class InfoServiceBase(object):
     @default_if_exception(default=dict(),
                           logger=logger,
                           msg="Getting Information Failed.")
-    def get_info(self, *names):
+    def get_info(self, *names, **kwargs):
         """
         :param name: str
         :return: info dict
         """
+        names = self._prepare_names(*names, **kwargs)
+        known_info = self._get_known_info()
+        if known_info:
+            return known_info
         info_items = self.get_search_results(*names)
         logger.info("Names[{}] got {} search results from {}.".format(names, len(info_items), self.NAME))
         info_item = self._get_most_likely_item(info_items, *names)
@@ -204,16 +340,20 @@ class RetrieveEntityFromRemoteMixin(object):
         """
         :return: info dict
         """
-        return self._generate_entity_info(self._get_entity_response(entity_pk))
+        return self._parse_response(self._get_entity_response(entity_pk), self._generate_entity_info)
 
     @default_if_exception(default=dict(),
                           logger=logger,
                           msg="Getting Information Failed.")
-    def get_info(self, *names):
+    def get_info(self, *names, **kwargs):
         """
         :param name: str
         :return: info dict
         """
+        names = self._prepare_names(*names, **kwargs)
+        known_info = self._get_known_info()
+        if known_info:
+            return known_info
         info_items = self.get_search_results(*names)
         logger.info("Names[{}] got {} search results from {}.".format(names, len(info_items), self.NAME))
         info_item = self._get_most_likely_item(info_items, *names)
@@ -231,6 +371,141 @@ class RetrieveEntityFromRemoteMixin(object):
         return info_item
 
 
+class AsyncInfoService(object):
+    """
+    asyncio interface of an info service, using the same hooks.
+    blocking requests run in the executor and are retried with jittered backoff without blocking the event loop.
+    errors are logged and give empty results like the sync interface, failed tells them apart from not found.
+    """
+    MAX_ATTEMPTS = 3
+    BACKOFF_BASE = 1
+    BACKOFF_MAX = 10
+
+    _searches = dict()
+
+    def __init__(self, service):
+        """
+        :param service: subclass of InfoServiceBase
+        """
+        self.service = service()
+        self.failed = False
+
+    async def _run(self, func, *args):
+        """
+        run func in the executor, retry on network or parse errors.
+        """
+        loop = asyncio.get_event_loop()
+        for attempt in range(self.MAX_ATTEMPTS):
+            try:
+                return await loop.run_in_executor(None, func, *args)
+            except Exception as e:
+                if attempt + 1 >= self.MAX_ATTEMPTS or not retry_if_network_error_or_parse_error(e):
+                    raise
+                await asyncio.sleep(random.uniform(0, min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2 ** attempt)))
+
+    @staticmethod
+    def _unwrap(method):
+        """
+        the method without its decorators, retries are done by _run.
+        """
+        return functools.partial(inspect.unwrap(method.__func__), method.__self__)
+
+    async def _search(self, name):
+        """
+        identical searches running at the same time share one request.
+        """
+        url, params = self.service._get_search_requests_params(name)
+        key = (asyncio.get_event_loop(),
+               type(self.service),
+               self.service._get_cache_key(url, params.get('params', None)))
+        future = self._searches.get(key, None)
+        if future is None:
+            future = self._searches[key] = asyncio.ensure_future(
+                self._run(self._unwrap(self.service._get_search_results), name))
+            future.add_done_callback(lambda x: self._searches.pop(key, None))
+        return copy.deepcopy(await asyncio.shield(future))
+
+    async def get_search_results(self, *names):
+        """
+        :return: list of info_dict, names are searched concurrently
+        """
+        try:
+            item_lists = await asyncio.gather(*[self._search(name) for name in names])
+        except:
+            logger.exception("Getting Search Results Failed. names: {}".format(names))
+            self.failed = True
+            return list()
+        results = collections.OrderedDict()
+        for item_list in item_lists:
+            results.update(collections.OrderedDict([(self.service._get_entity_pk_from_info_dict(x), x)
+                                                    for x in item_list[:self.service.SEARCH_MAX_NUMBER]]))
+        return list(results.values())
+
+    async def get_entity_info(self, entity_pk):
+        try:
+            return await self._run(self._unwrap(self.service.get_entity_info), entity_pk)
+        except:
+            logger.exception("Getting Information By Entity_PK Failed. entity_pk: {}".format(entity_pk))
+            self.failed = True
+            return dict()
+
+    async def get_info(self, *names, **kwargs):
+        """
+        :return: info dict
+        """
+        try:
+            names = self.service._prepare_names(*names, **kwargs)
+            known_info = await self._run(self.service._get_known_info)
+            if known_info:
+                return known_info
+            info_items = await self.get_search_results(*names)
+            logger.info("Names[{}] got {} search results from {}.".format(names, len(info_items), self.service.NAME))
+            info_item = self.service._get_most_likely_item(info_items, *names)
+            if info_item and isinstance(self.service, RetrieveEntityFromRemoteMixin):
+                info_item.update(await self.get_entity_info(self.service._get_entity_pk_from_info_dict(info_item)))
+            if info_item:
+                logger.info("Names[{}] got one matching result in "
+                            "{} search results. info_dict: {}".format(names, self.service.NAME, info_item))
+            else:
+                logger.info("Names[{}] got no matching result in "
+                            "{} search results.".format(names, self.service.NAME))
+            return info_item
+        except:
+            logger.exception("Getting Information Failed. names: {}".format(names))
+            self.failed = True
+            return dict()
+
+
+def run_async(coroutine, max_workers=None):
+    """
+    run coroutine in a new event loop like asyncio.run with its own default executor, database connections opened
+    by the response cache in the executor threads are kept for the whole run and closed once the executor is shut down.
+    :param max_workers: executor threads, INFO_SERVICE_MAX_WORKERS by default, the pools of the sessions have as many
+    """
+    thread_connections = list()
+
+    def record_connections():
+        thread_connections.extend(connections[alias] for alias in connections)
+
+    executor = ThreadPoolExecutor(max_workers=max_workers or settings.INFO_SERVICE_MAX_WORKERS,
+                                  initializer=record_connections)
+
+    async def main():
+        asyncio.get_running_loop().set_default_executor(executor)
+        return await coroutine
+
+    try:
+        return asyncio.run(main())
+    finally:
+        executor.shutdown(wait=True)  # asyncio.run doesn't wait for the default executor before python 3.9
+        for connection in thread_connections:
+            connection.inc_thread_sharing()  # the owner thread has exited
+            try:
+                connection.close()
+            finally:
+                connection.dec_thread_sharing()
+
+
 class ANNArtistInfoService(RetrieveEntityFromRemoteMixin,
                            InfoServiceBase):
     """
@@ -244,15 +519,18 @@ class ANNArtistInfoService(RetrieveEntityFromRemoteMixin,
     ENTITY_ENDPOINT = ANN_PEOPLE_ENDPOINT
     ENTITY_PK_NAME = "ann_pid"
     ENTITY_NAME_KEYS = ("name_en",)
+    PROVIDES = ("ann_pid", "name_ja", "name_en")
+    CACHE_TTL = 60 * 60 * 24 * 30
 
     MIN_RATIO = 1
     CONTAIN_WEIGHT = 0.1
     CONTAIN_WEIGHT_REVERSED = 0.1
+    MAX_ITEM_WEIGHT = 0.03
 
     def _get_item_weight(self, item):
         description = item.get("description", None)
         if description and "animator" in description.lower():
-            return 0.03
+            return self.MAX_ITEM_WEIGHT
         return 0
 
     def _get_search_requests_params(self, name):
@@ -260,24 +538,25 @@ class ANNArtistInfoService(RetrieveEntityFromRemoteMixin,
                                             'q': name}
                                  }
 
+    SEARCH_RESULTS_XPATH = etree.XPath('//a[contains(@href, "/encyclopedia/people.php?id=")]')
+    DESCRIPTION_XPATH = etree.XPath('.//i[1]')
+    PID_PATTERN = regex.compile(r"\d+")
+    TITLE_XPATH = etree.XPath('//*[@id="page-title"][1]')
+
     def _generate_search_results(self, response):
         info_list = list()
 
-        soup = BeautifulSoup(response.content, 'lxml')
-        search_results = soup.find_all('a', href=regex.compile(r"/encyclopedia/people.php\?id="))
-        for result in search_results:
+        for result in self.SEARCH_RESULTS_XPATH(parse_html(response.content, 'utf-8')):
             info_dict = dict()
-            try:
-                description = result.i.get_text(strip=True)
-                result.i.clear()
+            for description_tag in self.DESCRIPTION_XPATH(result):
+                description = get_text(description_tag, strip=True)
+                description_tag.clear(keep_tail=True)
                 if description:
                     info_dict["description"] = description
-            except AttributeError:
-                pass
             info_dict.update(
                 {
-                    self.ENTITY_PK_NAME: int(regex.findall(r"\d+", result.get('href'))[0]),
-                    self.ENTITY_NAME_KEYS[0]: result.get_text().strip()
+                    self.ENTITY_PK_NAME: int(self.PID_PATTERN.findall(result.get('href'))[0]),
+                    self.ENTITY_NAME_KEYS[0]: get_text(result).strip()
                 }
             )
             info_list.append(info_dict)
@@ -288,14 +567,10 @@ class ANNArtistInfoService(RetrieveEntityFromRemoteMixin,
 
     def _generate_entity_info(self, response):
         info_dict = dict()
-        soup = BeautifulSoup(response.content, 'lxml')
-        title_block = soup.find(id="page-title")
-        title_block.h1.clear()
-        original_name = title_block.get_text(strip=True)
-        pattern = regex.compile(r".*[\da-zA-Z]+.*")
-        if not regex.match(pattern, original_name):  # remove space between ja_name
-            if original_name.count(' ') == 1:
-                original_name = original_name.replace(' ', '')
+        title_block = self.TITLE_XPATH(parse_html(response.content, 'utf-8'))[0]
+        title_block.find('.//h1').clear(keep_tail=True)
+        original_name = get_text(title_block, strip=True)
+        original_name = remove_ja_name_space(original_name)
         if original_name:
             info_dict.update(
                 {
@@ -318,19 +593,22 @@ class MALCopyrightInfoService(RetrieveEntityFromRemoteMixin,
     ENTITY_ENDPOINT = MAL_ANIME_ENDPOINT
     ENTITY_PK_NAME = "mal_aid"
     ENTITY_NAME_KEYS = ("name_en",)
+    PROVIDES = ("mal_aid", "name_ja", "name_en")
+    CACHE_TTL = 60 * 60 * 24 * 30
 
     MIN_RATIO = 0.9
     CONTAIN_WEIGHT = 0.5
     CONTAIN_WEIGHT_REVERSED = 0.5
 
+    SEARCH_RESULTS_XPATH = etree.XPath('//a[@class="hoverinfo_trigger fw-b fl-l"]')
+    JA_NAME_XPATH = etree.XPath('//span[text()="Japanese:"][1]/..')
+
     def _generate_search_results(self, response):
         info_list = list()
 
-        soup = BeautifulSoup(response.content, 'lxml', from_encoding='utf-8')
-        search_results = soup.find_all('a', 'hoverinfo_trigger fw-b fl-l')
-        for result in search_results:
-            anime_id = int(result['id'].replace('sinfo', ''))
-            anime_name = result.strong.get_text()
+        for result in self.SEARCH_RESULTS_XPATH(parse_html(response.content, 'utf-8')):
+            anime_id = int(result.get('id').replace('sinfo', ''))
+            anime_name = get_text(result.find('.//strong'))
             if anime_id and anime_name:
                 info_list.append(
                     {
@@ -342,10 +620,8 @@ class MALCopyrightInfoService(RetrieveEntityFromRemoteMixin,
 
     def _generate_entity_info(self, response):
         info_dict = dict()
-        soup = BeautifulSoup(response.content, 'lxml', from_encoding='utf-8')
-        title_tag = soup.find("span", text='Japanese:')
-        if title_tag:
-            original_name = title_tag.parent.get_text(strip=True).replace("Japanese:", "")
+        for title_block in self.JA_NAME_XPATH(parse_html(response.content, 'utf-8'))[:1]:
+            original_name = get_text(title_block, strip=True).replace("Japanese:", "")
             if original_name:
                 info_dict.update(
                     {
@@ -368,6 +644,7 @@ class BangumiCopyrightInfoService(RetrieveEntityFromRemoteMixin,
     ENTITY_ENDPOINT = BANGUMI_SUBJECT_ENDPOINT
     ENTITY_PK_NAME = "bgm_sid"
     ENTITY_NAME_KEYS = ("name_ja", "name_zh")
+    PROVIDES = ("bgm_sid", "name_ja", "name_zh", "description")
 
     SEARCH_MAX_NUMBER = 20
 
@@ -382,11 +659,14 @@ class BangumiCopyrightInfoService(RetrieveEntityFromRemoteMixin,
 
     def _get_search_response(self, name):
         url, params = self._get_search_requests_params(name)
-        try:
-            return self._get(url, **params).json()['list']
-        except KeyError:
+        response = self._get(url, **params)
+        result = self._parse_response(response, lambda x: x.json())
+        if 'list' not in result:
             logger.warning("Name[{}] got incorrect result from bangumi.".format(name))
+        if not result.get('list', None):
+            self._set_negative_cache(response, self.NEGATIVE_CACHE_TTL)
             return list()
+        return result['list']
 
     def _generate_search_results(self, response):
         info_list = list()
@@ -418,11 +698,11 @@ class BangumiCopyrightInfoService(RetrieveEntityFromRemoteMixin,
             }
         return info_dict
 
-    def get_info(self, *names):
-        # remove katakana between brackets
-        pattern = regex.compile(r'[\(\[〈]([^\p{isHan}]?)*\p{IsKatakana}([^\p{isHan}]?)*[\)\]〉]$')
-        names = map(lambda x: pattern.sub('', x).strip(), names)
-        return super(BangumiCopyrightInfoService, self).get_info(*names)
+    # katakana between brackets
+    KATAKANA_PATTERN = regex.compile(r'[\(\[〈]([^\p{isHan}]?)*\p{IsKatakana}([^\p{isHan}]?)*[\)\]〉]$')
+
+    def _prepare_names(self, *names, **kwargs):
+        return tuple(self.KATAKANA_PATTERN.sub('', x).strip() for x in names)
 
 
 class GoogleKGSInfoService(InfoServiceBase):
@@ -434,7 +714,12 @@ class GoogleKGSInfoService(InfoServiceBase):
     SEARCH_ENDPOINT = GOOGLE_KGS_SEARCH_ENDPOINT
     SEARCH_MAX_NUMBER = 5
 
+    REQUESTS_PER_SECOND = 5
+    BURST = 10
+
     ENTITY_PK_NAME = "kgs_url"
+    PROVIDES = ("kgs_url", "description", "name_zh", "name_ja", "name_en", "wiki_zh", "wiki_ja", "wiki_en")
+    CACHE_TTL = 60 * 60 * 24 * 14
 
     MIN_RATIO = 0.93
     CONTAIN_WEIGHT = 0.07
@@ -445,11 +730,81 @@ class GoogleKGSInfoService(InfoServiceBase):
     TYPE_FILTERS = []
     DESCRIPTION_FILTER = []
 
+    MIN_RESULT_SCORE = 20
+    IDS_BATCH_SIZE = 20
+    # (service class, kgs_url, language codes) -> (expire time, info_dict), expiring with CACHE_TTL,
+    # shared by the run_async executor threads
+    ENTITY_CACHE = LRUCache(5000)
+
     def __init__(self):
         super().__init__()
         assert self.SEARCH_TYPE not in self.EXCLUDE_TYPES
         assert not any(x in self.EXCLUDE_TYPES for x in self.TYPE_FILTERS)
         self._language_codes = ("zh", "ja", "en")
+        self._kgs_url = None
+
+    def _get_entity_cache_key(self, kgs_url):
+        return type(self), kgs_url, tuple(self._language_codes)
+
+    def _get_cached_entity(self, kgs_url):
+        key = self._get_entity_cache_key(kgs_url)
+        with self.ENTITY_CACHE.lock:
+            expire_time, info_dict = self.ENTITY_CACHE.get(key, (None, None))
+            if expire_time is not None and expire_time <= timezone.now():
+                self.ENTITY_CACHE.pop(key, None)
+                return None
+            return info_dict
+
+    def _set_cached_entity(self, info_dict):
+        self.ENTITY_CACHE[self._get_entity_cache_key(info_dict['kgs_url'])] = (
+            timezone.now() + timedelta(seconds=self.CACHE_TTL), dict(info_dict))
+
+    @staticmethod
+    def _get_kgs_id(kgs_url):
+        return "/{}".format(kgs_url[len(GOOGLE_KGS_ENTITY_URI):])
+
+    @retry(stop_max_attempt_number=3,
+           wait_fixed=1000,
+           retry_on_exception=retry_if_network_error_or_parse_error)
+    def _get_entities(self, *kgs_urls):
+        response = self._get(self.search_url, params={
+            "key": settings.GOOGLE_KGRAPH_API_KEY,
+            "ids": [self._get_kgs_id(x) for x in kgs_urls],
+            "languages": self._language_codes,
+            "limit": len(kgs_urls)
+        })
+        return self._parse_response(response, lambda x: self._generate_items(x, min_score=None))
+
+    @default_if_exception(default=dict(),
+                          logger=logger,
+                          msg="Getting Entities Failed.")
+    def get_entities_info(self, *kgs_urls, language_codes=("zh", "ja", "en")):
+        """
+        get entities by ids lookups of IDS_BATCH_SIZE, cached entities are not requested again.
+        :return: dict of kgs_url: info_dict
+        """
+        self._language_codes = language_codes
+        results = dict()
+        missing = list()
+        for kgs_url in dict.fromkeys(kgs_urls):
+            info_dict = self._get_cached_entity(kgs_url)
+            if info_dict is None:
+                missing.append(kgs_url)
+            else:
+                results[kgs_url] = info_dict
+        for i in range(0, len(missing), self.IDS_BATCH_SIZE):
+            results.update((x['kgs_url'], x) for x in self._get_entities(*missing[i:i + self.IDS_BATCH_SIZE]))
+        logger.info("Got {} of {} entities from {}, {} requested.".format(len(results),
+                                                                          len(kgs_urls),
+                                                                          self.NAME,
+                                                                          len(missing)))
+        return {k: dict(v) for k, v in results.items()}
+
+    def _get_known_info(self):
+        if not self._kgs_url:
+            return dict()
+        return self.get_entities_info(self._kgs_url,
+                                      language_codes=self._language_codes).get(self._kgs_url, dict())
 
     def _get_names_from_info_dict(self, info_dict):
         return [value for key, value in info_dict.items() if key[:4] == "name"]
@@ -500,6 +855,12 @@ class GoogleKGSInfoService(InfoServiceBase):
         return info
 
     def _generate_search_results(self, response):
+        return self._generate_items(response, min_score=self.MIN_RESULT_SCORE)
+
+    def _generate_items(self, response, min_score=None):
+        """
+        :param min_score: results with lower resultScore are abandoned, ids lookups are not filtered by score
+        """
         info_list = list()
         for item in response.json()['itemListElement']:
             item_info = dict()
@@ -507,7 +868,7 @@ class GoogleKGSInfoService(InfoServiceBase):
             result = item['result']
             kgs_id = result['@id']
             item_info['kgs_url'] = "{}{}".format(GOOGLE_KGS_ENTITY_URI, kgs_id[4:])
-            if item['resultScore'] < 20:
+            if min_score is not None and item['resultScore'] < min_score:
                 logger.debug("KGS[{}] resultScore is too low. Abandoned.".format(kgs_id))
                 continue
 
@@ -550,12 +911,17 @@ class GoogleKGSInfoService(InfoServiceBase):
                     {"wiki_{}".format(x[0]): x[1].get('url', None) for x in wiki_info}
                 )
 
+            self._set_cached_entity(item_info)
             info_list.append(item_info)
         return info_list
 
-    def get_info(self, *names, language_codes=("zh", "ja", "en")):
+    def _prepare_names(self, *names, language_codes=("zh", "ja", "en"), kgs_url=None):
+        """
+        :param kgs_url: known entity, which is got by ids lookup instead of searching names
+        """
         self._language_codes = language_codes
-        return super(GoogleKGSInfoService, self).get_info(*names)
+        self._kgs_url = kgs_url
+        return names
 
 
 class GoogleKGSArtistInfoService(GoogleKGSInfoService):
@@ -577,11 +943,14 @@ class AtwikiInfoService(InfoServiceBase):
     BASE_URL = ATWIKI_SEARCH_URI
 
     MIN_RATIO = 2
+    PROVIDES = ("sakuga_wiki_id", "anime_wiki_id")
+    CACHE_TTL = 60 * 60 * 24 * 3
 
     PATTERNS = {
-        'sakuga_wiki_id': SAKUGAWIKI_URL_PATTERN,
-        'anime_wiki_id': ANIMEWIKI_URL_PATTERN
+        'sakuga_wiki_id': regex.compile(SAKUGAWIKI_URL_PATTERN),
+        'anime_wiki_id': regex.compile(ANIMEWIKI_URL_PATTERN)
     }
+    SEARCH_RESULTS_XPATH = etree.XPath('//a[{}]'.format(has_class('atwiki_search_title')))
 
     @retry(stop_max_attempt_number=3,
            wait_fixed=1000,
@@ -590,22 +959,23 @@ class AtwikiInfoService(InfoServiceBase):
         response = self._get_search_response(name)
         logger.info('Name[{}] got search response from {}.'.format(name, self.NAME))
         info_dict = dict()
-        for info in self._generate_search_results(response):
+        for info in self._parse_response(response, lambda x: list(self._generate_search_results(x))):
             if info['name_ja'] == name:
                 info_dict.update(info)
         info_dict.pop("name_ja", None)
+        if not info_dict:
+            self._set_negative_cache(response, self.NEGATIVE_CACHE_TTL)
         return [info_dict]
 
     def _get_search_requests_params(self, name):
         return '{}{}'.format(self.search_url, parse.quote(name)), dict()
 
     def _generate_search_results(self, response):
-        soup = BeautifulSoup(response.content, 'lxml')
-        for result in soup.find_all('a', 'atwiki_search_title'):
-            link = result['href']
-            result_name = result.get_text().split('-')[-1].strip()
+        for result in self.SEARCH_RESULTS_XPATH(parse_html(response.content, 'utf-8')):
+            link = result.get('href')
+            result_name = get_text(result).split('-')[-1].strip()
             for code, pattern in self.PATTERNS.items():
-                ids = regex.compile(pattern).findall(link)
+                ids = pattern.findall(link)
                 if len(ids) == 1:
                     yield {
                         code: ids[0],
@@ -627,16 +997,19 @@ class ASDBCopyrightInfoService(InfoServiceBase):
 
     ENTITY_PK_NAME = "anime_staff_database_link"
     ENTITY_NAME_KEYS = ("name_ja",)
+    PROVIDES = ("anime_staff_database_link", "name_ja")
+    CACHE_TTL = 60 * 60 * 24 * 3
 
     def _get_search_requests_params(self, name):
         return '{}{}'.format(self.BASE_URL, parse.quote(name, encoding='EUC-JP')), dict()
 
+    SEARCH_RESULTS_XPATH = etree.XPath('//h3[{}]//a[1]'.format(has_class('keyword')))
+
     def _generate_search_results(self, response):
         info_list = list()
-        soup = BeautifulSoup(response.content, 'lxml', from_encoding='EUC-JP')
-        for result in soup.find_all('h3', 'keyword'):
-            link = result.a['href']
-            result_name = result.a.get_text(strip=True)
+        for result in self.SEARCH_RESULTS_XPATH(parse_html(response.content, 'euc-jp')):
+            link = result.get('href')
+            result_name = get_text(result, strip=True)
             info_list.append(
                 {
                     self.ENTITY_PK_NAME: link,
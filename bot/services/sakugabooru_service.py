@@ -1,11 +1,24 @@
+import bisect
+import collections
+import itertools
+import json
 import logging
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
+from django.conf import settings
 from django.db import transaction
+from django.db.models import Q, Max
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import now
 from pybooru import Moebooru
 from pytz import utc
 
 from bot.constants import SAKUGABOORU_BASE_URL
+from bot.models import PostPage, SyncState, BooruTag
+from bot.services.utils.cache import LRUCache
+from bot.services.utils.ratelimit import RateLimiter
+from hub.fields import hash_it
 from hub.models import Post, Tag, Uploader
 
 logger = logging.getLogger("bot.services.sakugabooru")
@@ -14,71 +27,268 @@ logger = logging.getLogger("bot.services.sakugabooru")
 class SakugabooruService(object):
     BASE_URL = SAKUGABOORU_BASE_URL
     MAX_DEPTH = 11
+    PAGE_LIMIT = 100
+    TAG_PAGE_LIMIT = 1000
+    CACHE_SIZE = 1000
+    BACKFILL_STATE = "posts_backfill"
+    WATERMARK_STATE = "posts_watermark"
+    POST_UPDATE_FIELDS = ('source', 'file_size', 'is_shown', 'is_pending', 'md5', 'ext', 'created_at', 'score',
+                          'rating', 'sample_url', 'sample_file_size', 'uploader', 'fingerprint', 'update_time')
+    FINGERPRINT_KEYS = ('source', 'file_size', 'is_shown_in_index', 'status', 'md5', 'file_ext', 'created_at', 'score',
+                        'rating', 'sample_url', 'sample_file_size', 'author')
 
     def __init__(self):
         self.client = Moebooru(site_url=self.BASE_URL)
-        self.local_cache = dict()
+        self.local_cache = LRUCache(self.CACHE_SIZE)
+        self.saved_fingerprints = LRUCache(self.CACHE_SIZE)
         self.max_page = 1e9
         self.created_tags = list()
+        self.fetched_pages = LRUCache(max(1, self.CACHE_SIZE // self.PAGE_LIMIT))
+        self._page_index = None
+        self._sorted_page_index = None
+
+    @staticmethod
+    def _get_post_defaults(post_dict):
+        return {
+            'source': post_dict['source'],
+            'file_size': post_dict['file_size'],
+            'is_shown': post_dict['is_shown_in_index'],
+            'is_pending': post_dict['status'] == "pending",
+            'md5': post_dict['md5'],
+            'ext': post_dict['file_ext'],
+            'created_at': datetime.fromtimestamp(int(post_dict['created_at']), tz=utc),
+            'score': post_dict['score'],
+            'rating': post_dict['rating'],
+            'sample_url': post_dict['sample_url'],
+            'sample_file_size': post_dict['sample_file_size'],
+            'uploader_id': post_dict['author']
+        }
 
     def _save_post(self, post_dict):
-        post, created = Post.objects.update_or_create(
-            id=post_dict['id'],
-            defaults={
-                'source': post_dict['source'],
-                'file_size': post_dict['file_size'],
-                'is_shown': post_dict['is_shown_in_index'],
-                'is_pending': post_dict['status'] == "pending",
-                'md5': post_dict['md5'],
-                'ext': post_dict['file_ext'],
-                'created_at': datetime.fromtimestamp(int(post_dict['created_at']), tz=utc),
-                'score': post_dict['score'],
-                'rating': post_dict['rating'],
-                'sample_url': post_dict['sample_url'],
-                'sample_file_size': post_dict['sample_file_size']
-            })
-        tags = self.update_tags(post_dict['tags'].split(' '))
-        with transaction.atomic():
-            post.tags.clear()
-            for tag in tags:
-                post.tags.add(tag)
-        post.uploader = self.update_uploader(post_dict['author'], post.is_pending, post.is_shown)
-        post.save()
-        return post
+        posts = self._save_posts([post_dict])
+        if posts:
+            return posts[0]
+        return None
+
+    def _save_posts(self, post_dicts):
+        """
+        save a batch of post_dicts with a fixed number of queries, posts whose fingerprint is unchanged are skipped.
+        :param post_dicts: list of post_dict
+        :return: list of Post in the order of post_dicts
+        """
+        post_dicts = list(collections.OrderedDict((x['id'], x) for x in post_dicts).values())
+        if not post_dicts:
+            return list()
+        existing_posts = Post.objects.in_bulk([x['id'] for x in post_dicts])
+        fingerprints = {x['id']: self._fingerprint(x) for x in post_dicts}
+        changed_dicts = [x for x in post_dicts if x['id'] not in existing_posts or
+                         existing_posts[x['id']].fingerprint != fingerprints[x['id']]]
+
+        if changed_dicts:
+            tag_names = {post_dict['id']: post_dict['tags'].split() for post_dict in changed_dicts}
+            tags = {tag.name: tag for tag in self.update_tags(itertools.chain.from_iterable(tag_names.values()))}
+            self.update_uploaders(changed_dicts)
+
+            with transaction.atomic():
+                new_posts = list()
+                changed_posts = list()
+                for post_dict in changed_dicts:
+                    defaults = self._get_post_defaults(post_dict)
+                    defaults['fingerprint'] = fingerprints[post_dict['id']]
+                    post = existing_posts.get(post_dict['id'], None)
+                    if post is None:
+                        existing_posts[post_dict['id']] = Post(id=post_dict['id'], **defaults)
+                        new_posts.append(existing_posts[post_dict['id']])
+                    else:
+                        for k, v in defaults.items():
+                            setattr(post, k, v)
+                        post.update_time = now()
+                        changed_posts.append(post)
+                Post.objects.bulk_create(new_posts, ignore_conflicts=True)
+                Post.objects.bulk_update(changed_posts, self.POST_UPDATE_FIELDS)
+                self._save_post_tags(tag_names, tags)
+            logger.debug("Posts[{}] changed.".format(",".join(str(x['id']) for x in changed_dicts)))
+
+        for post_id, fingerprint in fingerprints.items():
+            self.saved_fingerprints[post_id] = fingerprint
+        return [existing_posts[x['id']] for x in post_dicts]
+
+    @classmethod
+    def _fingerprint(cls, post_dict):
+        """
+        hash of the fields of post_dict which are saved to Post.
+        """
+        content = {key: post_dict.get(key, None) for key in cls.FINGERPRINT_KEYS}
+        content['tags'] = sorted(post_dict['tags'].split())
+        return hash_it(json.dumps(content, sort_keys=True))
+
+    def _save_changed_posts(self, post_dicts):
+        """
+        save post_dicts whose content changed since they were saved last time.
+        :return: list of Post saved
+        """
+        return self._save_posts([x for x in post_dicts
+                                 if self.saved_fingerprints.get(x['id'], None) != self._fingerprint(x)])
+
+    def flush_cache(self, post_ids=None):
+        """
+        save cached post_dicts whose content changed since they were saved last time.
+        :param post_ids: list of post_id to be saved, all cached posts if None
+        :return: list of Post saved
+        """
+        if post_ids is None:
+            post_ids = list(self.local_cache.keys())
+        post_dicts = [self.local_cache.get(x, None) for x in post_ids]
+        return self._save_changed_posts([x for x in post_dicts if x])
 
     @staticmethod
-    def update_uploader(author, is_pending, is_shown):
-        uploader, created = Uploader.objects.get_or_create(name=author)
-        if is_shown and not (is_pending or uploader.in_whitelist):
-            uploader.in_whitelist = True
-            uploader.save()
-        return uploader
+    def _save_post_tags(tag_names, tags):
+        """
+        diff the Post<->Tag through table against tag_names and apply the difference.
+        :param tag_names: dict of post_id: list of tag names
+        :param tags: dict of tag name: Tag
+        """
+        through = Post.tags.through
+        expected = {(post_id, name) for post_id, names in tag_names.items() for name in names if name in tags}
+        stale_ids = list()
+        for pk, post_id, tag_id in through.objects.filter(post_id__in=list(tag_names.keys())).values_list(
+                'id', 'post_id', 'tag_id'):
+            if (post_id, tag_id) in expected:
+                expected.remove((post_id, tag_id))
+            else:
+                stale_ids.append(pk)
+        if stale_ids:
+            through.objects.filter(id__in=stale_ids).delete()
+        through.objects.bulk_create([through(post_id=post_id, tag_id=name) for post_id, name in expected],
+                                    ignore_conflicts=True)
 
-    def update_tag(self, tag):
-        res = self.client.tag_list(name=tag.name)
-        for tag_dict in res:
-            if tag_dict['name'] == tag.name:
-                if tag.type != tag_dict['type']:
-                    tag.type = tag_dict['type']
-                    tag.save()
-                    logger.info("Tag[{}] type has been updated.".format(tag.name))
+    @staticmethod
+    def update_uploaders(post_dicts):
+        Uploader.objects.bulk_create([Uploader(name=x['author']) for x in post_dicts], ignore_conflicts=True)
+        whitelist = {x['author'] for x in post_dicts if x['is_shown_in_index'] and x['status'] != "pending"}
+        if whitelist:
+            Uploader.objects.filter(name__in=whitelist, in_whitelist=False).update(in_whitelist=True)
+
+    def refresh_tag_mirror(self, full=False):
+        """
+        save tags of sakugabooru to the local mirror and apply type changes to Tag, TAG_PAGE_LIMIT tags per request.
+        :param full: fetch every tag instead of those newer than the mirror to catch type and count changes
+        :return: number of mirrored tags changed
+        """
+        after_id = 0 if full else BooruTag.objects.aggregate(max_id=Max('id'))['max_id'] or 0
+        count = 0
+        page = 1
+        while True:
+            # the api only orders tags by id descending, tags created meanwhile shift pages and are seen twice
+            res = self.client.tag_list(after_id=after_id, limit=self.TAG_PAGE_LIMIT, page=page, order='date')
+            count += self._save_booru_tags(res)
+            if len(res) < self.TAG_PAGE_LIMIT:
                 break
+            page += 1
+        logger.info("Tag mirror refreshed from {} pages, {} tags changed.".format(page, count))
+        return count
+
+    def _save_booru_tags(self, tag_dicts):
+        """
+        :param tag_dicts: tags from the api
+        :return: number of mirrored tags changed
+        """
+        existing = BooruTag.objects.in_bulk([x['id'] for x in tag_dicts])
+        new_tags = list()
+        changed_tags = list()
+        for tag_dict in tag_dicts:
+            booru_tag = existing.get(tag_dict['id'], None)
+            if booru_tag is None:
+                new_tags.append(BooruTag(id=tag_dict['id'], name=tag_dict['name'], type=tag_dict['type'],
+                                         count=tag_dict['count']))
+            elif (booru_tag.name, booru_tag.type, booru_tag.count) != (tag_dict['name'], tag_dict['type'],
+                                                                        tag_dict['count']):
+                booru_tag.name, booru_tag.type, booru_tag.count = tag_dict['name'], tag_dict['type'], tag_dict['count']
+                changed_tags.append(booru_tag)
+        BooruTag.objects.bulk_create(new_tags, batch_size=1000, ignore_conflicts=True)
+        BooruTag.objects.bulk_update(changed_tags, ['name', 'type', 'count'], batch_size=1000)
+        logger.debug("Tag mirror page saved: {} new, {} changed.".format(len(new_tags), len(changed_tags)))
+
+        types = {x.name: x.type for x in new_tags + changed_tags}
+        self._apply_tag_types(Tag.objects.filter(name__in=list(types.keys())), types)
+        return len(new_tags) + len(changed_tags)
+
+    @staticmethod
+    def _get_tag_types(names):
+        """
+        :param names: set of tag names
+        :return: dict of name: type from the local mirror
+        """
+        return dict(BooruTag.objects.filter(name__in=names).order_by('id').values_list('name', 'type'))
+
+    @staticmethod
+    def _apply_tag_types(tags, types):
+        changed = list()
+        for tag in tags:
+            if tag.name in types and tag.type != types[tag.name]:
+                tag.type = types[tag.name]
+                changed.append(tag)
+        Tag.objects.bulk_update(changed, ['type'], batch_size=1000)
+        if changed:
+            logger.info("Tag[{}] type has been updated.".format(",".join(tag.name for tag in changed)))
+        return changed
+
+    def _search_tag_types(self, names):
+        """
+        search tags missing from the local mirror by name and save them to the mirror.
+        :param names: set of tag names
+        :return: dict of name: type
+        """
+        booru_tags = list()
+        for name in names:
+            try:
+                booru_tags.extend(BooruTag(id=x['id'], name=x['name'], type=x['type'], count=x['count'])
+                                  for x in self.client.tag_list(name=name) if x['name'] == name)
+            except:
+                logger.exception("Update tag [{}] from sakugabooru failed.".format(name))
+        BooruTag.objects.bulk_create(booru_tags, ignore_conflicts=True)
+        return {x.name: x.type for x in booru_tags}
+
+    def _update_tag_types(self, tags):
+        """
+        update types of tags from the local mirror with one bulk update.
+        tags missing from the mirror trigger an incremental refresh of the mirror, and those still missing are
+        searched by name.
+        :param tags: list of Tag
+        :return: list of Tag updated
+        """
+        if not tags:
+            return list()
+        names = {tag.name for tag in tags}
+        types = self._get_tag_types(names)
+        if len(types) < len(names):
+            self.refresh_tag_mirror()
+            types = self._get_tag_types(names)
+        if len(types) < len(names):
+            types.update(self._search_tag_types(names - types.keys()))
+        return self._apply_tag_types(tags, types)
+
+    def update_tag(self, tag):
+        self._update_tag_types([tag])
         return tag
 
     def update_tags(self, tag_str_list, force_update=False):
-        tags = list()
-        for tag_str in tag_str_list:
-            tag, created = Tag.objects.get_or_create(name=tag_str)
+        tag_str_list = list(tag_str_list)
+        names = list(collections.OrderedDict.fromkeys(tag_str_list))
+        tags = Tag.objects.in_bulk(names)
+        created_names = [name for name in names if name not in tags]
+        if created_names:
+            Tag.objects.bulk_create([Tag(name=name) for name in created_names], ignore_conflicts=True)
+            tags.update(Tag.objects.in_bulk(created_names))
 
-            if created or force_update:
-                self.created_tags.append(tag)
-                try:
-                    self.update_tag(tag)
-                except:
-                    logger.exception("Update tag [] from sakugabooru failed.".format(tag.name))
+        updating_tags = [tags[name] for name in (names if force_update else created_names)]
+        self.created_tags.extend(updating_tags)
+        try:
+            self._update_tag_types(updating_tags)
+        except:
+            logger.exception("Update tags [{}] from sakugabooru failed.".format(",".join(x.name for x in updating_tags)))
 
-            tags.append(tag)
-        return tags
+        return [tags[name] for name in tag_str_list]
 
     def _get_post_dict_by_api(self, post_id):
         """
@@ -86,13 +296,16 @@ class SakugabooruService(object):
         :param post_id: Integer
         :return: success: post_dict; failed: None
         """
-        limit = 100
+        limit = self.PAGE_LIMIT
         post_dict = self.local_cache.get(post_id, None)
         if post_dict:
             return post_dict
         page_stack = list()
         min_page = 1
         page_stack.append(min_page)
+        predicted_page = self._predict_page(post_id)
+        if predicted_page > min_page:
+            page_stack.append(predicted_page)
         max_page = self.max_page
         while page_stack and len(page_stack) <= self.MAX_DEPTH:
             res = self._get_posts_page(page=page_stack[-1], limit=limit)
@@ -137,7 +350,7 @@ class SakugabooruService(object):
                     next_page = (self.max_page + page_stack[-1]) // 2
                 page_stack.append(next_page)
             else:
-                return self.local_cache.get(post_id)
+                return next((x for x in res if x['id'] == post_id), None)
 
         return self.local_cache.get(post_id, None)
 
@@ -147,24 +360,113 @@ class SakugabooruService(object):
             return posts[0]
         return None
 
+    @property
+    def page_index(self):
+        """
+        page: (first_id, last_id) of pages with PAGE_LIMIT, loaded from db once per instance.
+        """
+        if self._page_index is None:
+            self._page_index = {x.page: (x.first_id, x.last_id) for x in
+                                PostPage.objects.filter(limit=self.PAGE_LIMIT)}
+        return self._page_index
+
+    def _update_page_index(self, page, limit, res):
+        if int(limit) != self.PAGE_LIMIT:
+            return
+        page = int(page)
+        if res:
+            PostPage.objects.update_or_create(limit=self.PAGE_LIMIT, page=page,
+                                              defaults={'first_id': res[0]['id'],
+                                                        'last_id': res[-1]['id']})
+            if self._page_index is not None:
+                self._page_index[page] = (res[0]['id'], res[-1]['id'])
+        else:
+            PostPage.objects.filter(limit=self.PAGE_LIMIT, page__gte=page).delete()
+            if self._page_index is not None:
+                for key in [x for x in self._page_index if x >= page]:
+                    self._page_index.pop(key)
+        self._sorted_page_index = None
+
+    def _predict_page(self, post_id):
+        """
+        predict the page containing post_id by the page index.
+        :param post_id: Integer
+        :return: page number, 1 if the index knows nothing about post_id
+        """
+        if self._sorted_page_index is None:
+            self._sorted_page_index = sorted((first_id, page, last_id) for page, (first_id, last_id) in
+                                             self.page_index.items())
+        index = self._sorted_page_index
+        if not index:
+            return 1
+        i = bisect.bisect_left(index, (post_id,))
+        if i >= len(index):
+            first_id, page, last_id = index[-1]
+            return max(1, page - (post_id - first_id) // self.PAGE_LIMIT - 1)
+        first_id, page, last_id = index[i]
+        if last_id <= post_id:
+            return page
+        predicted_page = page + (last_id - post_id) // self.PAGE_LIMIT + 1
+        if i > 0:
+            predicted_page = min(predicted_page, max(page + 1, index[i - 1][1]))
+        return predicted_page
+
+    def _gen_id_query(self, post_ids):
+        """
+        :param post_ids: sorted list of post_id, no more than PAGE_LIMIT
+        :return: "id:" tag query of post_ids, a range if it fits in one page
+        """
+        if post_ids[-1] - post_ids[0] < self.PAGE_LIMIT:
+            return "id:{}..{}".format(post_ids[0], post_ids[-1])
+        return "id:{}".format(",".join(str(x) for x in post_ids))
+
+    def _get_post_dicts_by_ids(self, post_ids):
+        """
+        get post_dicts by searching "id:" tag query in chunks and save them to cache.
+        :param post_ids: list of post_id
+        :return: generator of list of post_dict found, one for each chunk
+        """
+        post_ids = sorted(set(post_ids))
+        for i in range(0, len(post_ids), self.PAGE_LIMIT):
+            yield self._search_posts(self._gen_id_query(post_ids[i:i + self.PAGE_LIMIT]))
+
+    def _search_posts(self, tags, limit=None):
+        limit = limit or self.PAGE_LIMIT
+        try:
+            res = self.client.post_list(tags=tags, limit=limit)
+            self._save_cache(res)
+            logger.info("Search[{}] got {} posts from sakugabooru.".format(tags, len(res)))
+            return res
+        except:
+            logger.exception("Failed to search posts [{}] from sakugabooru with limit[{}].".format(tags, limit))
+            return list()
+
     def update_posts(self, *post_ids):
+        updated = list()
         try:
+            found = {x for x in post_ids if x in self.local_cache}
+            updated.extend(self.flush_cache(list(found)))
+            # save every chunk at once, more ids than CACHE_SIZE would evict the first ones
+            for post_dicts in self._get_post_dicts_by_ids([x for x in post_ids if x not in found]):
+                found.update(x['id'] for x in post_dicts)
+                updated.extend(self._save_changed_posts(post_dicts))
+            pages = collections.defaultdict(list)
             for post_id in post_ids:
-                if post_id not in self.local_cache:
-                    if not self._get_post_dict_by_api(post_id):
-                        try:
-                            post = Post.objects.get(id=post_id)
-                            post.is_shown = False
-                            post.is_pending = False
-                            post.save()
-                        except Post.DoesNotExist:
-                            pass
+                if post_id not in found:
+                    pages[self._predict_page(post_id)].append(post_id)
+            for page, ids in sorted(pages.items()):
+                page_dicts = {x['id']: x for x in self._get_posts_page(page=page, limit=self.PAGE_LIMIT)}
+                post_dicts = list()
+                for post_id in ids:
+                    post_dict = page_dicts.get(post_id, None) or self._get_post_dict_by_api(post_id)
+                    if post_dict:
+                        post_dicts.append(post_dict)
+                    else:
+                        self._hide_posts(Post.objects.filter(id=post_id))
+                updated.extend(self._save_changed_posts(post_dicts))
         finally:
-            updated = []
-            for v in self.local_cache.values():
-                self._save_post(v)
-                updated.append(str(v['id']))
-            logger.info(f"Posts[{','.join(updated)}] Updated.")
+            updated.extend(self.flush_cache(list(post_ids)))
+            logger.info(f"Posts[{','.join([str(x.id) for x in updated])}] Updated.")
         return Post.objects.filter(id__in=post_ids)
 
     def _save_cache(self, res):
@@ -172,32 +474,165 @@ class SakugabooruService(object):
             self.local_cache[post_dict["id"]] = post_dict
 
     @staticmethod
-    def _refresh_is_shown(page_res):
-        if page_res:
-            for post in Post.objects.filter(id__gte=page_res[-1]['id'], id__lte=page_res[0]['id']).exclude(
-                    id__in=[x['id'] for x in page_res]):
-                post.is_pending = False
-                post.is_shown = False
-                post.save()
+    def _hide_posts(queryset):
+        """
+        mark posts of queryset which are still shown or pending as hidden.
+        :return: list of post_id hidden
+        """
+        queryset = queryset.filter(Q(is_shown=True) | Q(is_pending=True))
+        post_ids = list(queryset.values_list('id', flat=True))
+        if post_ids:
+            queryset.filter(id__in=post_ids).update(is_shown=False, is_pending=False, fingerprint='',
+                                                    update_time=now())
+            logger.info("Posts[{}] have been hidden.".format(",".join(str(x) for x in post_ids)))
+        return post_ids
+
+    def _refresh_is_shown(self, page_res):
+        """
+        hide posts between the first and the last post of page_res which are missing from it.
+        :return: list of post_id hidden
+        """
+        if not page_res:
+            return list()
+        return self._hide_posts(Post.objects.filter(id__gte=page_res[-1]['id'], id__lte=page_res[0]['id']).exclude(
+            id__in=[x['id'] for x in page_res]))
 
     def _get_posts_page(self, page=1, limit=100):
+        if (page, limit) in self.fetched_pages:
+            return self.fetched_pages[(page, limit)]
         try:
             res = self.client.post_list(page=page, limit=limit)
+            self.fetched_pages[(page, limit)] = res
             self._save_cache(res)
             self._refresh_is_shown(res)
+            self._update_page_index(page, limit, res)
             return res
         except:
             logger.exception("Failed to get posts page [{}] from sakugabooru with limit[{}].".format(page, limit))
             return dict()
 
     def update_posts_by_page(self, page=1, limit=100, escape_id=None):
-        posts = list()
+        post_dicts = list()
         logger.info("Getting posts page [{}] from sakugabooru with limit[{}].".format(page, limit))
         for post_dict in self._get_posts_page(page=page, limit=limit):
             if escape_id and post_dict["id"] <= escape_id:
                 break
-            post = self._save_post(post_dict)
-            if post:
-                posts.append(post)
+            post_dicts.append(post_dict)
+        posts = self._save_posts(post_dicts)
+        logger.info(f"Posts[{','.join([str(x.id) for x in posts])}] Updated.")
+        return posts
+
+    def _update_posts_by_query(self, tags, refresh_is_shown=False):
+        """
+        save every page of posts matching tags, in ascending order of id.
+        :return: generator of list of Post saved by page, stops when a page is not full
+        """
+        page = 1
+        while True:
+            logger.info("Getting posts[{}] page [{}] from sakugabooru.".format(tags, page))
+            res = self.client.post_list(tags="{} order:id".format(tags), page=page, limit=self.PAGE_LIMIT)
+            res = sorted(res, key=lambda x: x['id'], reverse=True)
+            self._save_cache(res)
+            if refresh_is_shown:
+                self._refresh_is_shown(res)
+            yield self._save_posts(res)
+            if len(res) < self.PAGE_LIMIT:
+                break
+            page += 1
+
+    def update_new_posts(self):
+        """
+        save posts newer than the watermark, the highest post_id synced so far.
+        :return: list of Post saved
+        """
+        state = SyncState.get_data(self.WATERMARK_STATE)
+        max_id = state.get('max_id', None)
+        if max_id is None:
+            try:
+                max_id = Post.objects.latest('id').id
+            except Post.DoesNotExist:
+                posts = self.update_posts_by_page()
+                if posts:
+                    state['max_id'] = posts[0].id
+                    SyncState.set_data(self.WATERMARK_STATE, state)
+                return posts
+        posts = list()
+        for page_posts in self._update_posts_by_query("id:>{}".format(max_id)):
+            posts.extend(page_posts)
+            if page_posts:
+                state['max_id'] = max(max_id, page_posts[0].id)
+                SyncState.set_data(self.WATERMARK_STATE, state)
         logger.info(f"Posts[{','.join([str(x.id) for x in posts])}] Updated.")
         return posts
+
+    def rescan_recent_posts(self, force=False):
+        """
+        refresh posts created in the last SAKUGABOORU_RESCAN_HOURS, at most once per SAKUGABOORU_RESCAN_INTERVAL.
+        :return: list of Post saved
+        """
+        state = SyncState.get_data(self.WATERMARK_STATE)
+        last_rescan = parse_datetime(state['last_rescan']) if state.get('last_rescan', None) else None
+        if not force and last_rescan and now() - last_rescan < timedelta(seconds=settings.SAKUGABOORU_RESCAN_INTERVAL):
+            return list()
+        recent_ids = Post.objects.filter(
+            created_at__gte=now() - timedelta(hours=settings.SAKUGABOORU_RESCAN_HOURS)).values_list('id', flat=True)
+        min_id = min(recent_ids, default=state.get('max_id', None))
+        if min_id is None:
+            return list()
+        posts = list()
+        for page_posts in self._update_posts_by_query("id:>={}".format(min_id), refresh_is_shown=True):
+            posts.extend(page_posts)
+        state = SyncState.get_data(self.WATERMARK_STATE)
+        state['last_rescan'] = now().isoformat()
+        SyncState.set_data(self.WATERMARK_STATE, state)
+        logger.info(f"Posts[{','.join([str(x.id) for x in posts])}] Rescanned.")
+        return posts
+
+    def _get_posts_window(self, low, high, rate_limiter):
+        rate_limiter.acquire()
+        return self.client.post_list(tags="id:{}..{}".format(low, high), limit=self.PAGE_LIMIT)
+
+    def _save_posts_window(self, window, future, state):
+        low, high = window
+        res = future.result()
+        self._save_posts(res)
+        self._hide_posts(Post.objects.filter(id__gte=low, id__lte=high).exclude(id__in=[x['id'] for x in res]))
+        state['next_id'] = low - 1
+        SyncState.set_data(self.BACKFILL_STATE, state)
+        logger.info("Posts[{}..{}]: {} posts backfilled.".format(low, high, len(res)))
+        return len(res)
+
+    def backfill_posts(self, end_id=1, start_id=None, resume=True, workers=None, requests_per_second=None):
+        """
+        save every post with id from start_id down to end_id, fetching id windows of PAGE_LIMIT concurrently.
+        progress is checkpointed after each window, so an interrupted backfill resumes where it stopped.
+        :param end_id: the oldest post_id
+        :param start_id: the newest post_id, the newest post of sakugabooru if not given
+        :param resume: continue the last backfill with the same end_id and start_id
+        :return: number of posts saved
+        """
+        workers = workers or settings.SAKUGABOORU_BACKFILL_WORKERS
+        if requests_per_second is None:
+            requests_per_second = settings.SAKUGABOORU_REQUESTS_PER_SECOND
+        state = SyncState.get_data(self.BACKFILL_STATE) if resume else dict()
+        if not (state.get('end_id') == end_id and start_id in (None, state.get('start_id'))):
+            if start_id is None:
+                res = self.client.post_list(limit=1)
+                if not res:
+                    return 0
+                start_id = res[0]['id']
+            state = {'start_id': start_id, 'end_id': end_id, 'next_id': start_id}
+        logger.info("Backfilling posts[{}..{}] from {}.".format(state['end_id'], state['start_id'], state['next_id']))
+
+        rate_limiter = RateLimiter(requests_per_second)
+        count = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = collections.deque()
+            for high in range(state['next_id'], end_id - 1, -self.PAGE_LIMIT):
+                window = (max(high - self.PAGE_LIMIT + 1, end_id), high)
+                futures.append((window, executor.submit(self._get_posts_window, *window, rate_limiter)))
+                if len(futures) >= workers * 2:
+                    count += self._save_posts_window(*futures.popleft(), state)
+            while futures:
+                count += self._save_posts_window(*futures.popleft(), state)
+        return count
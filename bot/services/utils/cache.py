@@ -0,0 +1,49 @@
+import collections
+import threading
+
+
+class LRUCache(collections.OrderedDict):
+    """
+    OrderedDict holding at most maxsize items, the least recently used ones are evicted first.
+    Single reads and writes are thread-safe, hold lock for compound operations.
+    """
+
+    def __init__(self, maxsize=1000, *args, **kwargs):
+        self.maxsize = maxsize
+        self.lock = threading.RLock()
+        super(LRUCache, self).__init__(*args, **kwargs)
+
+    def __getitem__(self, key):
+        with self.lock:
+            value = super(LRUCache, self).__getitem__(key)
+            self.move_to_end(key)
+            return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            super(LRUCache, self).__setitem__(key, value)
+            self.move_to_end(key)
+            while len(self) > self.maxsize:
+                self.popitem(last=False)
+
+    def __delitem__(self, key):
+        with self.lock:
+            super(LRUCache, self).__delitem__(key)
+
+    def pop(self, key, *args):
+        with self.lock:
+            return super(LRUCache, self).pop(key, *args)
+
+    def clear(self):
+        with self.lock:
+            super(LRUCache, self).clear()
+
+    def items(self):
+        with self.lock:
+            return list(super(LRUCache, self).items())
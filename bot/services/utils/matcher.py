@@ -0,0 +1,52 @@
+"""
+similarity of names on the scale of difflib.SequenceMatcher.ratio: 2 * matches / total length.
+the matcher used by info services is set by INFO_SERVICE_MATCHER, it's called with a cutoff below which a ratio
+only has to stay below the cutoff.
+"""
+import difflib
+
+
+def lcs_length(a, b):
+    """
+    length of the longest common subsequence, computed bit-parallel (Hyyrö) in O(len(a) * len(b) / word size).
+    """
+    if len(a) < len(b):
+        a, b = b, a
+    if not b:
+        return 0
+    masks = dict()
+    for i, c in enumerate(a):
+        masks[c] = masks.get(c, 0) | 1 << i
+    full = (1 << len(a)) - 1
+    v = full
+    for c in b:
+        u = v & masks.get(c, 0)
+        v = ((v + u) | (v - u)) & full
+    return len(a) - bin(v).count('1')
+
+
+def lcs_ratio(a, b, cutoff=0.0):
+    """
+    indel similarity, never below SequenceMatcher.ratio and the same when its matching blocks form a longest
+    common subsequence.
+    """
+    total = len(a) + len(b)
+    if not total:
+        return 1.0
+    return 2.0 * lcs_length(a, b) / total
+
+
+def difflib_ratio(a, b, cutoff=0.0):
+    return difflib.SequenceMatcher(None, a, b).ratio()
+
+
+def bounded_ratio(a, b, cutoff=0.0):
+    """
+    SequenceMatcher.ratio for pairs whose lcs_ratio reaches cutoff, lcs_ratio for the others.
+    lcs_ratio is an upper bound of SequenceMatcher.ratio, so a pair is below cutoff with either matcher or neither,
+    and the ratios reaching it are difflib's: the MIN_RATIO thresholds keep their meaning.
+    """
+    ratio = lcs_ratio(a, b)
+    if ratio < cutoff or ratio == 1:
+        return ratio
+    return difflib_ratio(a, b)
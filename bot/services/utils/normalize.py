@@ -0,0 +1,43 @@
+"""
+name normalization shared by info services, matchers and scripts, the tables are built once at import.
+"""
+import re
+import unicodedata
+from functools import lru_cache
+
+from bot.constants import SYNONYM_DICT
+
+_SYNONYMS = {unicodedata.normalize('NFKC', k): v for k, v in SYNONYM_DICT.items()}
+_SYNONYM_TABLE = str.maketrans({k: v for k, v in _SYNONYMS.items() if len(k) == 1})
+_SYNONYM_PATTERN = re.compile("|".join(re.escape(k) for k in sorted((k for k in _SYNONYMS if len(k) > 1),
+                                                                     key=len, reverse=True))) \
+    if any(len(k) > 1 for k in _SYNONYMS) else None
+_SPACE_PATTERN = re.compile(r"\s+")
+_LATIN_PATTERN = re.compile(r"[\da-zA-Z]")
+
+
+def replace_synonym(name):
+    name = name.translate(_SYNONYM_TABLE)
+    if _SYNONYM_PATTERN:
+        name = _SYNONYM_PATTERN.sub(lambda x: _SYNONYMS[x.group()], name)
+    return name
+
+
+@lru_cache(maxsize=4096)
+def normalize(name):
+    """
+    NFKC, replace synonyms, case fold and remove all spaces.
+    """
+    if not name:
+        return ""
+    name = replace_synonym(unicodedata.normalize('NFKC', name))
+    return _SPACE_PATTERN.sub("", name.casefold())
+
+
+def remove_ja_name_space(name):
+    """
+    remove the single space between family name and given name of a japanese name.
+    """
+    if name and not _LATIN_PATTERN.search(name) and name.count(' ') == 1:
+        return name.replace(' ', '')
+    return name
@@ -0,0 +1,79 @@
+import threading
+import time
+
+from django.db import connection
+from django.utils import timezone
+
+
+class RateLimiter(object):
+    """
+    thread-safe limiter which lets acquire return at most rate times per second.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next_time = 0
+
+    def acquire(self):
+        with self._lock:
+            current = time.monotonic()
+            wait = self._next_time - current
+            self._next_time = max(self._next_time, current) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+class TokenBucketRateLimiter(object):
+    """
+    token bucket of a host stored in the database, so that it is shared across processes.
+    acquire takes one token and sleeps until the token is refilled if the bucket is empty.
+    """
+    # hosts whose bucket row is known to exist in this process
+    _created_hosts = set()
+
+    def __init__(self, host, rate, burst=1):
+        self.host = host
+        self.rate = rate
+        self.burst = burst
+
+    def _create_bucket(self):
+        from bot.models import RateLimitBucket
+        RateLimitBucket.objects.get_or_create(host=self.host, defaults={'tokens': self.burst})
+        self._created_hosts.add(self.host)
+
+    def _take_token(self):
+        """
+        refill the bucket and take one token in one statement, the row lock of the update serializes workers.
+        :return: tokens left, None if the bucket doesn't exist
+        """
+        from bot.models import RateLimitBucket
+        current = timezone.now()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "UPDATE {table} SET "
+                "tokens = LEAST(%s, tokens + GREATEST(EXTRACT(EPOCH FROM %s - update_time), 0) * %s) - 1, "
+                "update_time = %s "
+                "WHERE host = %s RETURNING tokens".format(
+                    table=connection.ops.quote_name(RateLimitBucket._meta.db_table)),
+                [self.burst, current, self.rate, current, self.host])
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    def reserve(self):
+        """
+        :return: seconds to wait before the reserved token is available
+        """
+        if not self.rate:
+            return 0
+        tokens = self._take_token() if self.host in self._created_hosts else None
+        if tokens is None:
+            self._created_hosts.discard(self.host)
+            self._create_bucket()
+            tokens = self._take_token()
+        return max(-tokens / self.rate, 0)
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
@@ -0,0 +1,35 @@
+"""
+helpers for scraping html with lxml, xpath expressions should be compiled once with etree.XPath.
+"""
+from lxml import etree, html
+
+_parsers = dict()
+
+
+def parse_html(content, encoding=None):
+    """
+    :param content: bytes of the page
+    :param encoding: encoding of the page, detected from meta if None
+    :return: root element
+    """
+    parser = _parsers.get(encoding, None)
+    if parser is None:
+        parser = _parsers[encoding] = html.HTMLParser(encoding=encoding)
+    return etree.fromstring(content, parser)
+
+
+def has_class(name):
+    """
+    :return: xpath predicate which matches elements with css class name
+    """
+    return 'contains(concat(" ", normalize-space(@class), " "), " {} ")'.format(name)
+
+
+def get_text(element, strip=False):
+    """
+    text of element, like BeautifulSoup's get_text.
+    """
+    if strip:
+        return "".join(x.strip() for x in element.itertext())
+    return "".join(element.itertext())
+
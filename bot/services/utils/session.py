@@ -0,0 +1,27 @@
+import threading
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+_sessions = dict()
+_lock = threading.Lock()
+
+
+def get_session(url, headers=None, pool_maxsize=10):
+    """
+    process-wide session of the host of url, its pooled adapter keeps connections alive between services.
+    :param url: any url of the host
+    :param headers: default headers, only used when the session is created
+    :return: requests.Session
+    """
+    parsed = urlparse(url)
+    key = "{}://{}".format(parsed.scheme, parsed.netloc)
+    with _lock:
+        session = _sessions.get(key, None)
+        if session is None:
+            session = requests.session()
+            session.headers.update(headers or dict())
+            session.mount("{}/".format(key), HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize))
+            _sessions[key] = session
+    return session
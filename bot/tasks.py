@@ -1,21 +1,27 @@
+import asyncio
+import collections
 import logging
+import math
 import os
 import random
 from datetime import timedelta
 from urllib.parse import urlparse
 
-from celery import shared_task
+from celery import shared_task, group, chain
+from celery.exceptions import SoftTimeLimitExceeded
 from django.conf import settings
 from django.db import transaction
-from django.db.models import Count, Q
+from django.db.models import Count, Q, Min, Max
+from django.utils.dateparse import parse_datetime
 from django.utils.timezone import now
 from requests import HTTPError
 from rest_framework_simplejwt.token_blacklist.management.commands import flushexpiredtokens
 
-from bot.models import Weibo
+from bot.models import Weibo, SyncState, TagInfoProgress, TagInfoState, ResponseCache
 from bot.services.download_service import DownloadService
-from bot.services.info_service import AtwikiInfoService, ASDBCopyrightInfoService, ANNArtistInfoService, \
-    GoogleKGSArtistInfoService, MALCopyrightInfoService, BangumiCopyrightInfoService, GoogleKGSCopyrightInfoService
+from bot.services.info_service import AsyncInfoService, AtwikiInfoService, ASDBCopyrightInfoService, \
+    ANNArtistInfoService, GoogleKGSArtistInfoService, MALCopyrightInfoService, BangumiCopyrightInfoService, \
+    GoogleKGSCopyrightInfoService, run_async
 from bot.services.media_service import MediaService
 from bot.services.sakugabooru_service import SakugabooruService
 from bot.services.weiboV2_service import WeiboService
@@ -23,14 +29,41 @@ from hub.models import Post, Tag, Node
 
 logger = logging.getLogger('bot.tasks')
 TIME_LIMIT = settings.TASK_TIME_LIMIT
+TAGS_INFO_RUN = "update_all_tags_info"
+TAGS_INFO_REFRESH_STATE = "tags_info_refresh"
+TAG_MIRROR_REFRESH_STATE = "tag_mirror_refresh"
+# estimated provider requests of getting info of a tag
+TAG_INFO_COSTS = {Tag.ARTIST: 3, Tag.COPYRIGHT: 5}
+
+
+class InfoStep(object):
+    def __init__(self, service, get_names, requires=(), overwrite_keys=(), **kwargs):
+        """
+        :param service: subclass of InfoServiceBase
+        :param get_names: function which returns names to be searched from the info of the required keys
+        :param requires: keys of info needed by get_names
+        """
+        self.service = service
+        self.get_names = get_names
+        self.requires = set(requires)
+        self.overwrite_keys = overwrite_keys
+        self.kwargs = kwargs
+        self.dependencies = list()
 
 
 class TagInfoUpdateTask(object):
+    """
+    Info services run concurrently, each one waits only for the services which provide the keys it requires.
+    Their results are merged in the order they are added, the same as running them one by one.
+    """
+
     def __init__(self, tag, overwrite=False):
         assert isinstance(tag, Tag)
         self.tag = tag
         self.overwrite = overwrite
         self.info = dict()
+        self.steps = list()
+        self.results = dict()
 
     def _save_info_to_tag(self):
         for k, v in self.info.items():
@@ -45,81 +78,191 @@ class TagInfoUpdateTask(object):
                 except AttributeError:
                     pass
 
-    def _get_and_save_info(self, service, *names, overwrite_keys=(), **kwargs):
-        logger.info("Tag[{}]: Getting result from {} with names {}".format(self.tag.name, service.__name__, names))
-        service_instance = service()
-        info = service_instance.get_info(*names, **kwargs)
-        for k, v in info.items():
+    def _add_step(self, service, get_names, requires=(), overwrite_keys=(), **kwargs):
+        step = InfoStep(service, get_names, requires, overwrite_keys, **kwargs)
+        step.dependencies = [x for x in self.steps if step.requires & set(x.service.PROVIDES)]
+        self.steps.append(step)
+
+    @staticmethod
+    def _merge_info(info, new_info, overwrite_keys=()):
+        for k, v in new_info.items():
             if k in overwrite_keys:
-                self.info[k] = v
+                info[k] = v
                 continue
-            self.info.setdefault(k, v)
-
-    def get_values_from_info(self, *keys):
-        return [self.info.get(key, None) for key in keys if self.info.get(key, None)]
+            info.setdefault(k, v)
+
+    async def _get_info(self, step, futures):
+        info = dict()
+        for dependency in step.dependencies:
+            self._merge_info(info, await futures[dependency], dependency.overwrite_keys)
+        names = step.get_names(info)
+        logger.info("Tag[{}]: Getting result from {} with names {}".format(self.tag.name, step.service.__name__, names))
+        service = AsyncInfoService(step.service)
+        info = await service.get_info(*names, **step.kwargs)
+        self.results[step.service.__name__] = None if service.failed else bool(info)
+        return info
+
+    async def run_steps_async(self):
+        futures = dict()
+        for step in self.steps:
+            futures[step] = asyncio.ensure_future(self._get_info(step, futures))
+        results = await asyncio.gather(*futures.values(), return_exceptions=True)
+        for step, result in zip(self.steps, results):
+            if isinstance(result, BaseException):
+                logger.error("Tag[{}]: Getting result from {} failed.".format(self.tag.name, step.service.__name__),
+                             exc_info=result)
+                self.results[step.service.__name__] = None
+            else:
+                self._merge_info(self.info, result, step.overwrite_keys)
+        self.steps = list()
+
+    def run_steps(self):
+        run_async(self.run_steps_async())
+
+    @staticmethod
+    def get_values_from_info(info, *keys):
+        return [info.get(key, None) for key in keys if info.get(key, None)]
 
     def translate_artist(self):
         if self.tag.type != Tag.ARTIST:
             return
         name = self.tag.name.replace("_", " ")
-        self._get_and_save_info(ANNArtistInfoService, name)
-        names = [name] + self.get_values_from_info('name_ja')
-        self._get_and_save_info(GoogleKGSArtistInfoService,
-                                *names,
-                                overwrite_keys=('description',))
+        self._add_step(ANNArtistInfoService, lambda info: [name])
+        self._add_step(GoogleKGSArtistInfoService,
+                       lambda info: [name] + self.get_values_from_info(info, 'name_ja'),
+                       requires=('name_ja',),
+                       overwrite_keys=('description',),
+                       kgs_url=self.tag.detail.get('kgs_url', None))
 
     def translate_copyright(self):
         if self.tag.type != Tag.COPYRIGHT:
             return
         name = self.tag.name.replace("_", " ")
-        self._get_and_save_info(MALCopyrightInfoService, name)
-        names = [name] + self.get_values_from_info('name_ja')
-        self._get_and_save_info(BangumiCopyrightInfoService,
-                                *names,
-                                overwrite_keys=("name_ja",))
+        self._add_step(MALCopyrightInfoService, lambda info: [name])
+        self._add_step(BangumiCopyrightInfoService,
+                       lambda info: [name] + self.get_values_from_info(info, 'name_ja'),
+                       requires=('name_ja',),
+                       overwrite_keys=("name_ja",))
         try:
             source = self.tag.post_set.latest('id').source
         except Post.DoesNotExist:
             source = ''
         if len(self.tag.name) > 6 and (len(source) < 10 or not bool(urlparse(source).netloc)):
-            names = [name] + self.get_values_from_info('name_ja', 'name_zh')
-            self._get_and_save_info(GoogleKGSCopyrightInfoService,
-                                    *names,
-                                    overwrite_keys=('description',))
+            self._add_step(GoogleKGSCopyrightInfoService,
+                           lambda info: [name] + self.get_values_from_info(info, 'name_ja', 'name_zh'),
+                           requires=('name_ja', 'name_zh'),
+                           overwrite_keys=('description',),
+                           kgs_url=self.tag.detail.get('kgs_url', None))
 
     def get_additional_info(self):
         if self.tag.type not in (Tag.ARTIST, Tag.COPYRIGHT):
             return
-        ja_names = []
-        if self.tag.ja_name:
-            ja_names.append(self.tag.ja_name)
-        ja_names.extend(self.get_values_from_info('name_ja'))
-        if not ja_names:
-            ja_names = [self.tag.name.replace("_", " ")]
-        self._get_and_save_info(AtwikiInfoService, *ja_names)
+        tag_ja_name = self.tag.ja_name
+
+        def get_ja_names(info):
+            ja_names = []
+            if tag_ja_name:
+                ja_names.append(tag_ja_name)
+            ja_names.extend(self.get_values_from_info(info, 'name_ja'))
+            if not ja_names:
+                ja_names = [self.tag.name.replace("_", " ")]
+            return ja_names
+
+        self._add_step(AtwikiInfoService, get_ja_names, requires=('name_ja',))
         if self.tag.type == Tag.COPYRIGHT:
-            self._get_and_save_info(ASDBCopyrightInfoService, *ja_names)
+            self._add_step(ASDBCopyrightInfoService, get_ja_names, requires=('name_ja',))
+
+    def _save_states(self):
+        current = now()
+        for provider, found in self.results.items():
+            if found is None:  # failed, keep the last time and retry later
+                state, _ = TagInfoState.objects.get_or_create(tag_id=self.tag.pk,
+                                                              provider=provider,
+                                                              defaults={'last_time': None})
+                state.failures += 1
+                state.last_attempt = current
+                state.retry_time = current + get_retry_delay(state.failures)
+                state.save(update_fields=['failures', 'last_attempt', 'retry_time'])
+                continue
+            TagInfoState.objects.update_or_create(tag_id=self.tag.pk,
+                                                  provider=provider,
+                                                  defaults={'found': found,
+                                                            'last_time': current,
+                                                            'last_attempt': current,
+                                                            'failures': 0,
+                                                            'retry_time': None})
+        self.results = dict()
 
     @transaction.atomic
     def save(self):
         self.tag.refresh_from_db()
         self._save_info_to_tag()
+        self._save_states()
         return self.tag.save()
 
+    def add_steps(self):
+        self.translate_artist()
+        self.translate_copyright()
+        self.get_additional_info()
+
     def process(self):
         try:
-            self.translate_artist()
-            self.translate_copyright()
-            self.get_additional_info()
+            self.add_steps()
+            self.run_steps()
         finally:
             return self.save()
 
 
-def update_tags_info(*tags, update_tag_type=False, overwrite=False):
+async def _run_tag_info_tasks(tasks):
+    semaphore = asyncio.Semaphore(settings.INFO_SERVICE_CONCURRENT_TAGS)
+
+    async def run(task):
+        async with semaphore:
+            await task.run_steps_async()
+
+    results = await asyncio.gather(*[run(task) for task in tasks], return_exceptions=True)
+    for task, result in zip(tasks, results):
+        if isinstance(result, BaseException):
+            logger.error("Tag[{}]: Running info steps failed.".format(task.tag.name), exc_info=result)
+
+
+def _prefetch_kgs_entities(tasks):
+    """
+    known kgs entities of all tags are got in batched ids lookups, so that their steps hit the entity cache.
+    """
+    kgs_urls = collections.defaultdict(list)
+    for task in tasks:
+        for step in task.steps:
+            if step.kwargs.get('kgs_url', None):
+                kgs_urls[step.service].append(step.kwargs['kgs_url'])
+    for service, urls in kgs_urls.items():
+        service().get_entities_info(*urls)
+
+
+def update_tags_info(*tags, update_tag_type=False, overwrite=False, on_saved=None):
+    """
+    info of tags is got concurrently in one event loop, and saved one by one.
+    :param on_saved: function called with each tag after it is saved
+    """
     if update_tag_type:
         tags = SakugabooruService().update_tags([tag.name for tag in tags], force_update=True)
+    tasks = list()
     for tag in tags:
-        TagInfoUpdateTask(tag, overwrite).process()
+        task = TagInfoUpdateTask(tag, overwrite)
+        try:
+            task.add_steps()
+        except:
+            logger.exception("Tag[{}]: Adding info steps failed.".format(tag.name))
+            task.steps = list()
+        tasks.append(task)
+    try:
+        _prefetch_kgs_entities(tasks)
+        run_async(_run_tag_info_tasks(tasks))
+    finally:
+        for task in tasks:
+            task.save()
+            if on_saved:
+                on_saved(task.tag)
 
 
 @shared_task(soft_time_limit=TIME_LIMIT)
@@ -128,10 +271,156 @@ def update_tags_info_task(*tag_pks, update_tag_type=False, overwrite=False):
     update_tags_info(*tags, update_tag_type=update_tag_type, overwrite=overwrite)
 
 
+@shared_task(soft_time_limit=TIME_LIMIT)
+def update_tags_info_chunk(run, *tag_pks, update_tag_type=False, overwrite=False):
+    """
+    chunk of a bulk tag info update, saved tags are recorded in TagInfoProgress.
+    errors are logged instead of raised, so that the following chunks still run.
+    """
+    tags = Tag.objects.filter(pk__in=tag_pks).exclude(taginfoprogress__run=run)
+    try:
+        update_tags_info(*tags,
+                         update_tag_type=update_tag_type,
+                         overwrite=overwrite,
+                         on_saved=lambda tag: TagInfoProgress.objects.get_or_create(run=run, tag_id=tag.pk))
+    except:
+        logger.exception("Tags info[{}]: Chunk {} failed.".format(run, tag_pks))
+
+
+def get_tags_info_progress(run):
+    """
+    :return: dict of done and total tags, throughput in tags per minute and eta
+    """
+    state = SyncState.get_data(run)
+    done = TagInfoProgress.objects.filter(run=run).count()
+    total = state.get('total', done)
+    minutes = 0
+    if state.get('start_time', None):
+        minutes = (now() - parse_datetime(state['start_time'])).total_seconds() / 60
+    rate = (done - state.get('done_before', 0)) / minutes if minutes > 0 else 0
+    return {
+        'run': run,
+        'done': done,
+        'total': total,
+        'tags_per_minute': rate,
+        'eta': str(timedelta(minutes=round((total - done) / rate))) if rate > 0 else None,
+        'finished': state.get('finished', False)
+    }
+
+
 @shared_task
-def update_all_tags_info(update_tag_type=True, overwrite=True):
-    tags = Tag.objects.filter(type__in=[Tag.ARTIST, Tag.COPYRIGHT])
-    update_tags_info(*tags, update_tag_type=update_tag_type, overwrite=overwrite)
+def report_tags_info_progress(run, finished=False):
+    if finished:
+        SyncState.set_data(run, dict(SyncState.get_data(run), finished=True))
+    progress = get_tags_info_progress(run)
+    logger.info("Tags info[{run}]: {done}/{total} done, {tags_per_minute:.1f} tags/min, ETA: {eta}.".format(**progress))
+    return progress
+
+
+@shared_task
+def update_all_tags_info(update_tag_type=True, overwrite=True, resume=True):
+    """
+    tags are updated in chunks of TAGS_INFO_CHUNK_SIZE, TAGS_INFO_CONCURRENCY chunks run as a chord at a time,
+    and the progress is reported after each chord.
+    :param resume: skip tags done by the last unfinished run
+    :return: number of tags to be updated
+    """
+    run = TAGS_INFO_RUN
+    if not resume or SyncState.get_data(run).get('finished', True):
+        TagInfoProgress.objects.filter(run=run).delete()
+    tag_pks = list(Tag.objects.filter(type__in=[Tag.ARTIST, Tag.COPYRIGHT]).exclude(
+        taginfoprogress__run=run).order_by('pk').values_list('pk', flat=True))
+    done = TagInfoProgress.objects.filter(run=run).count()
+    SyncState.set_data(run, {'total': done + len(tag_pks),
+                             'done_before': done,
+                             'start_time': now().isoformat(),
+                             'finished': False})
+    logger.info("Tags info[{}]: {} tags to be updated, {} done before.".format(run, len(tag_pks), done))
+
+    size = settings.TAGS_INFO_CHUNK_SIZE
+    chunks = [tag_pks[i:i + size] for i in range(0, len(tag_pks), size)]
+    concurrency = settings.TAGS_INFO_CONCURRENCY
+    workflow = list()
+    for i in range(0, len(chunks), concurrency):
+        workflow.append(group(update_tags_info_chunk.si(run,
+                                                        *chunk,
+                                                        update_tag_type=update_tag_type,
+                                                        overwrite=overwrite) for chunk in chunks[i:i + concurrency]))
+        workflow.append(report_tags_info_progress.si(run, finished=i + concurrency >= len(chunks)))
+    if not workflow:
+        workflow.append(report_tags_info_progress.si(run, finished=True))
+    chain(*workflow).apply_async()
+    return len(tag_pks)
+
+
+def get_retry_delay(failures):
+    """
+    :param failures: count of failures in a row of a provider
+    :return: timedelta doubling from TAGS_INFO_RETRY_HOURS, at most TAGS_INFO_STALE_DAYS
+    """
+    return min(timedelta(hours=settings.TAGS_INFO_RETRY_HOURS) * 2 ** min(failures - 1, 16),
+               timedelta(days=settings.TAGS_INFO_STALE_DAYS))
+
+
+def get_stale_tags(budget):
+    """
+    artist and copyright tags not enriched in TAGS_INFO_STALE_DAYS or with a failed provider,
+    by priority, as many as budget allows. tags with a failed provider are skipped until its retry time.
+    priority grows with the post count, with recent posts and with the time since the tag was enriched,
+    and drops with the failures in a row.
+    :param budget: number of provider requests
+    :return: list of tag pk
+    """
+    current = now()
+    stale_days = settings.TAGS_INFO_STALE_DAYS
+    tags = Tag.objects.filter(type__in=TAG_INFO_COSTS.keys()).annotate(
+        enriched_time=Min('taginfostate__last_time'),
+        failures=Max('taginfostate__failures'),
+        waiting_count=Count('taginfostate', filter=Q(taginfostate__retry_time__gt=current)),
+        post_count=Count('post', distinct=True),
+        last_post_time=Max('post__created_at')
+    ).filter(
+        Q(enriched_time__isnull=True) | Q(enriched_time__lt=current - timedelta(days=stale_days)) |
+        Q(failures__gt=0),
+        waiting_count=0
+    ).values_list('pk', 'type', 'enriched_time', 'post_count', 'last_post_time', 'failures')
+
+    def get_priority(item):
+        pk, type, enriched_time, post_count, last_post_time, failures = item
+        age = min((current - enriched_time).days / stale_days, 4) if enriched_time else 4
+        recency = 1 / (1 + (current - last_post_time).days / 30) if last_post_time else 0
+        return math.log1p(post_count) + age + recency - (failures or 0)
+
+    tag_pks = list()
+    for pk, type, *_ in sorted(tags, key=get_priority, reverse=True):
+        if budget < TAG_INFO_COSTS[type]:
+            break
+        budget -= TAG_INFO_COSTS[type]
+        tag_pks.append(pk)
+    return tag_pks
+
+
+@shared_task(soft_time_limit=TIME_LIMIT)
+def refresh_stale_tags_info(force=False):
+    """
+    re-enrich the stale tags of highest priority within TAGS_INFO_HOURLY_BUDGET provider requests,
+    at most once per TAGS_INFO_REFRESH_INTERVAL.
+    """
+    try:
+        state = SyncState.get_data(TAGS_INFO_REFRESH_STATE)
+        last_time = parse_datetime(state['last_time']) if state.get('last_time', None) else None
+        if not force and last_time and now() - last_time < timedelta(seconds=settings.TAGS_INFO_REFRESH_INTERVAL):
+            return
+        used = TagInfoState.objects.filter(last_attempt__gte=now() - timedelta(hours=1)).count()
+        tag_pks = get_stale_tags(settings.TAGS_INFO_HOURLY_BUDGET - used)
+        SyncState.set_data(TAGS_INFO_REFRESH_STATE, {'last_time': now().isoformat(), 'tags': len(tag_pks)})
+        logger.info("Refreshing info of {} stale tags, "
+                    "{} provider requests used in the last hour.".format(len(tag_pks), used))
+        size = settings.TAGS_INFO_CHUNK_SIZE
+        for i in range(0, len(tag_pks), size):
+            update_tags_info_task.delay(*tag_pks[i:i + size])
+    except:
+        logger.exception("Refresh_stale_tags_info failed.")
 
 
 def update_posts(*posts):
@@ -143,30 +432,71 @@ def update_posts(*posts):
         update_tags_info(*booru.created_tags)
 
 
+@shared_task(soft_time_limit=TIME_LIMIT)
+def refresh_tag_mirror_task(full=True, force=False):
+    """
+    refresh the whole local mirror of sakugabooru tags at most once per TAG_MIRROR_REFRESH_INTERVAL,
+    the mirror only fetches new tags otherwise.
+    """
+    try:
+        state = SyncState.get_data(TAG_MIRROR_REFRESH_STATE)
+        last_time = parse_datetime(state['last_time']) if state.get('last_time', None) else None
+        if not force and last_time and now() - last_time < timedelta(seconds=settings.TAG_MIRROR_REFRESH_INTERVAL):
+            return
+        count = SakugabooruService().refresh_tag_mirror(full=full)
+        SyncState.set_data(TAG_MIRROR_REFRESH_STATE, {'last_time': now().isoformat(), 'tags': count})
+    except:
+        logger.exception("Refresh_tag_mirror_task failed.")
+
+
 @shared_task(soft_time_limit=TIME_LIMIT)
 def update_posts_task(*post_pks):
     update_posts(*Post.objects.filter(pk__in=post_pks))
 
 
+@shared_task(soft_time_limit=TIME_LIMIT)
+def backfill_posts_task(end_id=1, start_id=None, resume=True):
+    """
+    backfill posts, the task is queued again to resume from the checkpoint when it exceeds its time limit.
+    """
+    booru = SakugabooruService()
+    try:
+        logger.info("Backfilling posts from sakugabooru.")
+        booru.backfill_posts(end_id=end_id, start_id=start_id, resume=resume)
+    except SoftTimeLimitExceeded:
+        logger.info("Backfilling posts exceeded the time limit, queued to resume from the checkpoint.")
+        backfill_posts_task.delay(end_id=end_id, start_id=start_id, resume=True)
+    finally:
+        tag_pks = list(dict.fromkeys(tag.pk for tag in booru.created_tags))
+        size = settings.TAGS_INFO_CHUNK_SIZE
+        for i in range(0, len(tag_pks), size):
+            update_tags_info_task.delay(*tag_pks[i:i + size])
+
+
 @shared_task(soft_time_limit=TIME_LIMIT)
 def auto_update_posts():
     booru = SakugabooruService()
     try:
         logger.info("Updating posts from sakugabooru.")
-        last_post = Post.objects.latest('id')
-        page = 1
-        posts = booru.update_posts_by_page(page=page)
-        while posts[-1].id > last_post.id + 1 or page < 3:
-            page += 1
-            posts = booru.update_posts_by_page(page=page)
-    except Post.DoesNotExist:
-        booru.update_posts_by_page()
+        booru.update_new_posts()
     except:
         logger.exception("Auto_update_posts failed.")
     finally:
         update_tags_info(*booru.created_tags)
 
 
+@shared_task(soft_time_limit=TIME_LIMIT)
+def rescan_recent_posts(force=False):
+    booru = SakugabooruService()
+    try:
+        logger.info("Rescanning recent posts from sakugabooru.")
+        booru.rescan_recent_posts(force=force)
+    except:
+        logger.exception("Rescan_recent_posts failed.")
+    finally:
+        update_tags_info(*booru.created_tags)
+
+
 def post_weibo(*posts):
     weibo_service = WeiboService()
     for post in posts:
@@ -279,13 +609,28 @@ def clean_nodes():
         logger.info("Following Nodes have been deleted.: {}".format(nodes))
 
 
+@shared_task(soft_time_limit=TIME_LIMIT)
+def clean_response_cache():
+    """
+    delete responses expired for INFO_SERVICE_CACHE_PURGE_DAYS, recently expired ones are kept for revalidation.
+    """
+    count, _ = ResponseCache.objects.filter(
+        expire_time__lt=now() - timedelta(days=settings.INFO_SERVICE_CACHE_PURGE_DAYS)).delete()
+    if count:
+        logger.info("{} expired responses have been deleted.".format(count))
+
+
 @shared_task(soft_time_limit=TIME_LIMIT)
 def bot_auto_task():
     try:
         auto_update_posts()
+        rescan_recent_posts()
+        refresh_tag_mirror_task()
+        refresh_stale_tags_info()
         auto_post_weibo()
     finally:
         clean_media()
+        clean_response_cache()
 
 
 @shared_task
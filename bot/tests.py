@@ -1,4 +1,9 @@
-from django.test import SimpleTestCase, TestCase
+from datetime import timedelta
+
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now
 
 from hub.models import Tag
 from scripts.init import init_attributes
@@ -45,6 +50,703 @@ class TestTasks(TestCase):
                              })
 
 
+class FakeMoebooru(object):
+    def __init__(self, tag_types=None, post_ids=()):
+        self.tag_types = tag_types or dict()
+        self.posts = [gen_post_dict(x, "effects") for x in sorted(post_ids, reverse=True)]
+        self.post_list_calls = list()
+        self.tag_list_calls = list()
+
+    def post_list(self, page=1, limit=100, tags=None, **kwargs):
+        if not tags:
+            self.post_list_calls.append(int(page))
+            start = (int(page) - 1) * int(limit)
+            return self.posts[start:start + int(limit)]
+        self.post_list_calls.append(tags)
+        query = tags.split()[0][len("id:"):]
+        if query.startswith(">="):
+            posts = [x for x in self.posts if x['id'] >= int(query[2:])]
+        elif query.startswith(">"):
+            posts = [x for x in self.posts if x['id'] > int(query[1:])]
+        elif ".." in query:
+            low, high = [int(x) for x in query.split("..")]
+            posts = [x for x in self.posts if low <= x['id'] <= high]
+        else:
+            posts = [x for x in self.posts if x['id'] in {int(x) for x in query.split(",")}]
+        if "order:id" in tags:
+            posts = list(reversed(posts))
+        start = (int(page) - 1) * int(limit)
+        return posts[start:start + int(limit)]
+
+    def tag_list(self, after_id=0, name=None, limit=0, page=1, order=None, **kwargs):
+        self.tag_list_calls.append(name or after_id)
+        tags = [{'id': i, 'name': k, 'type': v, 'count': 1} for i, (k, v) in enumerate(self.tag_types.items(), 1)
+                if (name in k if name else i > after_id)]
+        if order == 'date':
+            tags = list(reversed(tags))
+        if int(limit):
+            start = (int(page) - 1) * int(limit)
+            tags = tags[start:start + int(limit)]
+        return tags
+
+
+def gen_post_dict(post_id, tags, author="uploader", status="active", score=0):
+    return {
+        'id': post_id,
+        'tags': tags,
+        'author': author,
+        'status': status,
+        'score': score,
+        'source': '',
+        'file_size': 1024,
+        'is_shown_in_index': True,
+        'md5': '{:032x}'.format(post_id),
+        'file_ext': 'mp4',
+        'created_at': 1500000000 + post_id,
+        'rating': 's',
+        'sample_url': 'https://www.sakugabooru.com/data/{:032x}.mp4'.format(post_id),
+        'sample_file_size': 0
+    }
+
+
+class TestSakugabooruService(TestCase):
+    def setUp(self):
+        from bot.services.sakugabooru_service import SakugabooruService
+        self.service = SakugabooruService()
+        self.service.client = FakeMoebooru({'yutaka_nakamura': Tag.ARTIST})
+
+    def test_save_posts(self):
+        from hub.models import Post, Uploader
+        posts = self.service._save_posts([gen_post_dict(1, "yutaka_nakamura effects"),
+                                          gen_post_dict(2, "effects", status="pending")])
+        self.assertEqual([x.id for x in posts], [1, 2])
+        self.assertEqual(Tag.objects.get(name="yutaka_nakamura").type, Tag.ARTIST)
+        self.assertEqual(sorted(Post.objects.get(id=1).tags.values_list('name', flat=True)),
+                         ["effects", "yutaka_nakamura"])
+        self.assertTrue(Post.objects.get(id=2).is_pending)
+        self.assertTrue(Uploader.objects.get(name="uploader").in_whitelist)
+
+        self.service._save_posts([gen_post_dict(1, "effects smoke", score=5)])
+        post = Post.objects.get(id=1)
+        self.assertEqual(post.score, 5)
+        self.assertEqual(sorted(post.tags.values_list('name', flat=True)), ["effects", "smoke"])
+
+    def test_page_index(self):
+        from bot.services.sakugabooru_service import SakugabooruService
+        from bot.models import PostPage
+        client = FakeMoebooru(post_ids=range(1, 2001))
+        self.service.client = client
+        self.service._get_post_dicts_by_ids = lambda post_ids: list()
+        self.assertEqual(self.service.update_post(1234).id, 1234)
+        self.assertTrue(PostPage.objects.filter(first_id__gte=1234, last_id__lte=1234).exists())
+
+        service = SakugabooruService()
+        service.client = client
+        client.post_list_calls = list()
+        service._get_post_dicts_by_ids = lambda post_ids: list()
+        service.update_posts(1234, 1210, 1250)
+        self.assertEqual(client.post_list_calls, [8])
+
+    def test_update_posts_by_ids(self):
+        self.service.client = FakeMoebooru(post_ids=list(range(1, 2001)) + [3000])
+        posts = self.service.update_posts(5, 20, 1500, 3000, 2500)
+        self.assertEqual(sorted(x.id for x in posts), [5, 20, 1500, 3000])
+        self.assertEqual(self.service.client.post_list_calls[0], "id:5,20,1500,2500,3000")
+        self.assertEqual(self.service.client.post_list_calls[1], 1)
+        from hub.models import Post
+        self.assertFalse(Post.objects.filter(id=1999).exists())
+
+    def test_update_posts_over_cache_size(self):
+        from hub.models import Post
+        self.service.local_cache.maxsize = 150
+        self.service.client = FakeMoebooru(post_ids=range(1, 401))
+        self.service.update_posts(*range(1, 351))
+        self.assertEqual(Post.objects.count(), 350)
+        self.assertEqual(len(self.service.client.post_list_calls), 4)
+
+    def test_refresh_is_shown(self):
+        from hub.models import Post
+        self.service._save_posts([gen_post_dict(x, "effects") for x in range(1, 11)])
+        page_res = [gen_post_dict(x, "effects") for x in (9, 7, 2)]
+        self.assertEqual(sorted(self.service._refresh_is_shown(page_res)), [3, 4, 5, 6, 8])
+        self.assertFalse(Post.objects.get(id=5).is_shown)
+        self.assertTrue(Post.objects.get(id=10).is_shown)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.service._refresh_is_shown(page_res), [])
+
+    def test_backfill_posts(self):
+        from hub.models import Post
+        client = FakeMoebooru(post_ids=[x for x in range(1, 451) if x % 7])
+        post_list = client.post_list
+
+        def interrupted_post_list(*args, tags=None, **kwargs):
+            if tags == "id:1..50":
+                raise IOError()
+            return post_list(*args, tags=tags, **kwargs)
+
+        self.service.client = client
+        client.post_list = interrupted_post_list
+        with self.assertRaises(IOError):
+            self.service.backfill_posts(workers=2, requests_per_second=0)
+        self.assertEqual(Post.objects.count(), 450 - 450 // 7 - 50 + 50 // 7)
+
+        client.post_list = post_list
+        client.post_list_calls = list()
+        self.assertEqual(self.service.backfill_posts(workers=2, requests_per_second=0), 50 - 50 // 7)
+        self.assertEqual(client.post_list_calls, ["id:1..50"])
+        self.assertEqual(Post.objects.count(), 450 - 450 // 7)
+
+    def test_backfill_posts_task_time_limit(self):
+        from unittest.mock import patch
+        from celery.exceptions import SoftTimeLimitExceeded
+        from bot.services.sakugabooru_service import SakugabooruService
+        from bot.tasks import backfill_posts_task
+        with patch.object(SakugabooruService, 'backfill_posts', side_effect=SoftTimeLimitExceeded()), \
+                patch.object(backfill_posts_task, 'delay') as delay:
+            backfill_posts_task(end_id=1, resume=False)
+        delay.assert_called_once_with(end_id=1, start_id=None, resume=True)
+
+    def test_update_new_posts(self):
+        from bot.models import SyncState
+        self.service._save_posts([gen_post_dict(100, "effects")])
+        client = FakeMoebooru(post_ids=range(1, 251))
+        self.service.client = client
+        self.assertEqual(len(self.service.update_new_posts()), 150)
+        self.assertEqual(client.post_list_calls, ["id:>100 order:id"] * 2)
+        self.assertEqual(SyncState.get_data(self.service.WATERMARK_STATE)['max_id'], 250)
+
+        client.posts = [gen_post_dict(x, "effects") for x in range(255, 0, -1)]
+        client.post_list_calls = list()
+        self.assertEqual([x.id for x in self.service.update_new_posts()], [255, 254, 253, 252, 251])
+        self.assertEqual(client.post_list_calls, ["id:>250 order:id"])
+
+        client.post_list_calls = list()
+        self.assertEqual([x.id for x in self.service.rescan_recent_posts(force=True)], [255])
+        self.assertEqual(self.service.rescan_recent_posts(), [])
+        self.assertEqual(client.post_list_calls, ["id:>=255 order:id"])
+
+    def test_local_cache(self):
+        self.service.local_cache.maxsize = 150
+        self.service.client = FakeMoebooru(post_ids=range(1, 401))
+        for page in range(1, 4):
+            self.service._get_posts_page(page=page)
+        self.assertEqual(len(self.service.local_cache), 150)
+        self.assertIn(201, self.service.local_cache)
+        self.assertNotIn(300, self.service.local_cache)
+        self.assertEqual(len(self.service.flush_cache([250, 201])), 2)
+        self.assertEqual(self.service.flush_cache([250, 201]), [])
+        self.assertEqual(self.service.flush_cache([]), [])
+        self.assertEqual(len(self.service.flush_cache()), 148)
+
+    def test_update_tags(self):
+        client = FakeMoebooru({'effects': Tag.GENERAL, 'yutaka_nakamura': Tag.ARTIST})
+        self.service.client = client
+        self.assertEqual(self.service.refresh_tag_mirror(), 2)
+        client.tag_types['mob_psycho_100'] = Tag.COPYRIGHT
+        tags = self.service.update_tags(["yutaka_nakamura", "mob_psycho_100", "effects", "yutaka_nakamura"])
+        self.assertEqual([x.type for x in tags], [Tag.ARTIST, Tag.COPYRIGHT, Tag.GENERAL, Tag.ARTIST])
+        self.assertEqual(Tag.objects.get(name="mob_psycho_100").type, Tag.COPYRIGHT)
+        self.assertEqual(client.tag_list_calls, [0, 2])
+
+        client.tag_types['effects'] = Tag.META
+        self.service.update_tags(["effects"], force_update=True)
+        self.assertEqual(len(client.tag_list_calls), 2)
+        self.service.refresh_tag_mirror(full=True)
+        self.assertEqual(Tag.objects.get(name="effects").type, Tag.META)
+        self.assertEqual(client.tag_list_calls[-1], 0)
+
+        # existing tags missing from the mirror
+        from bot.models import BooruTag
+        Tag.objects.bulk_create([Tag(name="kyoto_animation"), Tag(name="hibike_euphonium")])
+        client.tag_types['kyoto_animation'] = Tag.META
+        BooruTag.objects.filter(name="yutaka_nakamura").delete()
+        Tag.objects.filter(name="yutaka_nakamura").update(type=Tag.GENERAL)
+        self.service.update_tag(Tag.objects.get(name="kyoto_animation"))
+        self.assertEqual(Tag.objects.get(name="kyoto_animation").type, Tag.META)
+        self.assertEqual(client.tag_list_calls[-1], 3)
+
+        client.tag_types['hibike_euphonium'] = Tag.COPYRIGHT
+        tags = self.service.update_tags(["yutaka_nakamura", "hibike_euphonium"], force_update=True)
+        self.assertEqual([x.type for x in tags], [Tag.ARTIST, Tag.COPYRIGHT])
+        self.assertEqual(client.tag_list_calls[-2:], [4, "yutaka_nakamura"])
+        self.assertTrue(BooruTag.objects.filter(name="yutaka_nakamura").exists())
+
+    def test_refresh_tag_mirror_pages(self):
+        from bot.models import BooruTag
+        client = FakeMoebooru({"tag_{}".format(i): Tag.GENERAL for i in range(25)})
+        self.service.client = client
+        self.service.TAG_PAGE_LIMIT = 10
+        Tag.objects.bulk_create([Tag(name="tag_3"), Tag(name="tag_24")])
+        client.tag_types["tag_3"] = Tag.ARTIST
+        self.assertEqual(self.service.refresh_tag_mirror(full=True), 25)
+        self.assertEqual(client.tag_list_calls, [0, 0, 0])
+        self.assertEqual(BooruTag.objects.count(), 25)
+        self.assertEqual(Tag.objects.get(name="tag_3").type, Tag.ARTIST)
+        client.tag_types["tag_24"] = Tag.META
+        self.assertEqual(self.service.refresh_tag_mirror(full=True), 1)
+        self.assertEqual(Tag.objects.get(name="tag_24").type, Tag.META)
+
+    def test_refresh_tag_mirror_task(self):
+        from unittest.mock import patch
+        from bot.services.sakugabooru_service import SakugabooruService
+        from bot.tasks import refresh_tag_mirror_task
+        with patch.object(SakugabooruService, 'refresh_tag_mirror', return_value=0) as refresh:
+            refresh_tag_mirror_task()
+            refresh_tag_mirror_task()
+            refresh.assert_called_once_with(full=True)
+            refresh_tag_mirror_task(force=True)
+            self.assertEqual(refresh.call_count, 2)
+
+    def test_save_posts_unchanged(self):
+        from hub.models import Post
+        self.service._save_posts([gen_post_dict(1, "effects")])
+        update_time = Post.objects.get(id=1).update_time
+        with self.assertNumQueries(1):
+            self.service._save_posts([gen_post_dict(1, "effects")])
+        self.assertEqual(Post.objects.get(id=1).update_time, update_time)
+
+        self.service._hide_posts(Post.objects.filter(id=1))
+        self.service._save_posts([gen_post_dict(1, "effects")])
+        self.assertTrue(Post.objects.get(id=1).is_shown)
+
+    def test_save_posts_query_count(self):
+        self.service._save_posts([gen_post_dict(i, "effects") for i in range(1, 8)])
+        with CaptureQueriesContext(connection) as one:
+            self.service._save_posts([gen_post_dict(1, "fighting")])
+        with CaptureQueriesContext(connection) as many:
+            self.service._save_posts([gen_post_dict(i, "smoke") for i in range(1, 8)])
+        self.assertEqual(len(one), len(many))
+
+
+class FakeSession(object):
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = list()
+
+    def get(self, url, **kwargs):
+        self.calls.append((url, kwargs))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def gen_response(content, status_code=200, **headers):
+    import requests
+    response = requests.models.Response()
+    response.status_code = status_code
+    response.url = "https://example.com/"
+    response.headers.update(headers)
+    response.encoding = 'utf-8'
+    response._content = content.encode()
+    return response
+
+
+class TestTagsInfoProgress(TestCase):
+
+    def test_update_tags_info_chunk(self):
+        from bot.models import SyncState, TagInfoProgress
+        from bot.tasks import update_tags_info_chunk, get_tags_info_progress
+        tags = [Tag.objects.create(name="tag_{}".format(i), type=Tag.GENERAL) for i in range(3)]
+        SyncState.set_data("test", {'total': 3, 'done_before': 0, 'start_time': (now() - timedelta(minutes=1)).isoformat()})
+        update_tags_info_chunk("test", *[tag.pk for tag in tags[:2]])
+        self.assertEqual(set(TagInfoProgress.objects.filter(run="test").values_list('tag_id', flat=True)),
+                         {tag.pk for tag in tags[:2]})
+        progress = get_tags_info_progress("test")
+        self.assertEqual((progress['done'], progress['total']), (2, 3))
+        self.assertAlmostEqual(progress['tags_per_minute'], 2, delta=0.1)
+        self.assertEqual(progress['eta'], '0:01:00')
+
+
+class TestStaleTags(TestCase):
+
+    def test_get_stale_tags(self):
+        from bot.models import TagInfoState
+        from bot.tasks import get_stale_tags
+        from hub.models import Post
+        popular, unknown, fresh, stale, _ = Tag.objects.bulk_create([  # not to trigger get_tag_info
+            Tag(name="popular", type=Tag.ARTIST),
+            Tag(name="unknown", type=Tag.ARTIST),
+            Tag(name="fresh", type=Tag.COPYRIGHT),
+            Tag(name="stale", type=Tag.COPYRIGHT),
+            Tag(name="general", type=Tag.GENERAL)
+        ])
+        for i in range(1, 6):
+            post = Post.objects.create(id=i, md5=str(i), ext='mp4', created_at=now())
+            post.tags.add(popular, fresh)
+        TagInfoState.objects.create(tag=popular, provider="ANNArtistInfoService", last_time=now() - timedelta(days=40))
+        TagInfoState.objects.create(tag=fresh, provider="MALCopyrightInfoService", last_time=now())
+        TagInfoState.objects.create(tag=stale, provider="MALCopyrightInfoService", last_time=now() - timedelta(days=60))
+        self.assertEqual(get_stale_tags(100), ["popular", "unknown", "stale"])
+        self.assertEqual(get_stale_tags(6), ["popular", "unknown"])
+        self.assertEqual(get_stale_tags(2), [])
+
+    def test_failed_provider(self):
+        from bot.models import TagInfoState
+        from bot.tasks import TagInfoUpdateTask, get_stale_tags
+        tag, = Tag.objects.bulk_create([Tag(name="tag", type=Tag.ARTIST)])
+        last_time = now() - timedelta(days=1)
+        TagInfoState.objects.create(tag=tag, provider="ANNArtistInfoService", found=True, last_time=last_time)
+        task = TagInfoUpdateTask(tag)
+        task.results = {"ANNArtistInfoService": None, "AtwikiInfoService": False}
+        task._save_states()
+        self.assertEqual(TagInfoState.objects.get(tag=tag, provider="ANNArtistInfoService").last_time, last_time)
+        self.assertEqual(get_stale_tags(100), [])
+
+        task.results = {"GoogleKGSArtistInfoService": None}
+        task._save_states()
+        state = TagInfoState.objects.get(tag=tag, provider="GoogleKGSArtistInfoService")
+        self.assertIsNone(state.last_time)
+        self.assertEqual(get_stale_tags(100), [])
+        TagInfoState.objects.filter(retry_time__isnull=False).update(retry_time=now())
+        self.assertEqual(get_stale_tags(100), ["tag"])
+
+        task.results = {"GoogleKGSArtistInfoService": None, "ANNArtistInfoService": True}
+        task._save_states()
+        state = TagInfoState.objects.get(tag=tag, provider="GoogleKGSArtistInfoService")
+        self.assertEqual(state.failures, 2)
+        self.assertEqual(state.retry_time - state.last_attempt, timedelta(hours=12))
+        state = TagInfoState.objects.get(tag=tag, provider="ANNArtistInfoService")
+        self.assertEqual((state.failures, state.retry_time), (0, None))
+
+    def test_always_failed_provider(self):
+        from bot.models import TagInfoState
+        from bot.tasks import TagInfoUpdateTask, get_stale_tags
+        from hub.models import Post
+        popular, unknown = Tag.objects.bulk_create([Tag(name="popular", type=Tag.ARTIST),
+                                                    Tag(name="unknown", type=Tag.ARTIST)])
+        for i in range(1, 51):
+            Post.objects.create(id=i, md5=str(i), ext='mp4', created_at=now()).tags.add(popular)
+        self.assertEqual(get_stale_tags(3), ["popular"])
+        for day in range(5):
+            task = TagInfoUpdateTask(popular)
+            task.results = {"ANNArtistInfoService": True, "GoogleKGSArtistInfoService": None}
+            task._save_states()
+            self.assertEqual(get_stale_tags(3), ["unknown"])
+            TagInfoState.objects.update(retry_time=now())
+        self.assertEqual(TagInfoState.objects.get(provider="GoogleKGSArtistInfoService").failures, 5)
+        self.assertEqual(get_stale_tags(3), ["unknown"])
+
+
+class TestInfoServiceCache(TestCase):
+
+    def setUp(self):
+        from bot.services.info_service import BangumiCopyrightInfoService
+        self.service = BangumiCopyrightInfoService()
+
+    def test_clean(self):
+        from bot.models import ResponseCache
+        from bot.tasks import clean_response_cache
+        response = gen_response('{"list": []}')
+        response.url = "https://example.com/search?key=secret&q=a"
+        self.service._save_cached_response("a", response)
+        self.service._save_cached_response("b", gen_response('{"list": []}'))
+        self.assertEqual(ResponseCache.objects.get(key="a").url, "https://example.com/search")
+        ResponseCache.objects.filter(key="a").update(expire_time=now() - timedelta(days=8))
+        ResponseCache.objects.filter(key="b").update(expire_time=now() - timedelta(days=1))
+        clean_response_cache()
+        self.assertEqual([x.key for x in ResponseCache.objects.all()], ["b"])
+
+    def test_cache_hit(self):
+        self.service.session = FakeSession(gen_response('{"list": [{"id": 1, "name": "a", "name_cn": ""}]}'))
+        self.assertEqual(self.service._get_search_results("a"), [{'bgm_sid': 1, 'name_ja': 'a'}])
+        self.assertEqual(self.service._get_search_results("a"), [{'bgm_sid': 1, 'name_ja': 'a'}])
+        self.assertEqual(len(self.service.session.calls), 1)
+
+    def test_revalidate(self):
+        from bot.models import ResponseCache
+        self.service.session = FakeSession(gen_response('{"list": []}', ETag='"v1"'),
+                                           gen_response('', 304))
+        self.assertEqual(self.service._get_search_results("a"), list())
+        cache = ResponseCache.objects.get()
+        self.assertLess(cache.expire_time, now() + timedelta(seconds=self.service.NEGATIVE_CACHE_TTL + 1))
+        ResponseCache.objects.update(expire_time=now())
+        self.assertEqual(self.service._get_search_results("a"), list())
+        self.assertEqual(self.service.session.calls[1][1]['headers'], {'If-None-Match': '"v1"'})
+        self.assertFalse(ResponseCache.objects.get().is_expired)
+
+    def test_parse_error(self):
+        from bot.models import ResponseCache
+        self.service.session = FakeSession(gen_response('not json'), gen_response('{"list": []}'))
+        self.assertEqual(self.service.get_search_results("a"), list())
+        self.assertEqual(len(self.service.session.calls), 2)
+        self.assertEqual(ResponseCache.objects.count(), 1)
+
+
+class TestMatcher(SimpleTestCase):
+    NAMES = [
+        ("yuuko sera", "Yuuko Sera"),
+        ("yuki hayashi", "Yūki Hayashi"),
+        ("kishin douji zenki", "Kishin Douji Zenki: Gaiden"),
+        ("violet evergarden", "Violet Evergarden Gaiden: Eien to Jidou Shuki Ningyou"),
+        ("big fish & begonia", "Big Fish & Begonia (Dayu Haitang)"),
+        ("ヴァイオレット・エヴァーガーデン", "劇場版 ヴァイオレット・エヴァーガーデン"),
+        ("紫罗兰永恒花园", "紫罗兰永恒花园 外传"),
+        ("賭ケグルイ", "賭ケグルイ××"),
+        ("shingeki no kyojin", "Attack on Titan"),
+        ("", "abc"),
+        ("", ""),
+    ]
+
+    def test_normalize(self):
+        from bot.services.utils.normalize import normalize, remove_ja_name_space
+        self.assertEqual(normalize("Yūki  HAYASHI"), "yukihayashi")
+        self.assertEqual(normalize("ＡＫＩＲＡ！"), "akira!")
+        self.assertEqual(normalize(None), "")
+        self.assertEqual(remove_ja_name_space("世良 悠子"), "世良悠子")
+        self.assertEqual(remove_ja_name_space("世良 悠子 2"), "世良 悠子 2")
+
+    def test_lcs_length(self):
+        from bot.services.utils.matcher import lcs_length
+        self.assertEqual(lcs_length("abcbdab", "bdcaba"), 4)
+        self.assertEqual(lcs_length("abc", ""), 0)
+        self.assertEqual(lcs_length("abc", "abc"), 3)
+
+    def test_equivalence(self):
+        from bot.services.utils.matcher import lcs_ratio, difflib_ratio
+        from bot.services.utils.normalize import normalize
+        # difflib's matching blocks are not always a longest common subsequence, but they are for similar names
+        for original, target in self.NAMES:
+            original, target = normalize(original), normalize(target)
+            ratio, difflib_ratio_ = lcs_ratio(original, target), difflib_ratio(original, target)
+            self.assertGreaterEqual(ratio, difflib_ratio_ - 1e-9)
+            if difflib_ratio_ >= 0.5:
+                self.assertAlmostEqual(ratio, difflib_ratio_, msg="{} {}".format(original, target))
+            else:
+                self.assertLess(ratio, 0.5)
+
+    def test_min_ratio_boundary(self):
+        from bot.services.info_service import ANNArtistInfoService, MALCopyrightInfoService, \
+            BangumiCopyrightInfoService, GoogleKGSArtistInfoService, GoogleKGSCopyrightInfoService, \
+            AtwikiInfoService, ASDBCopyrightInfoService
+        from bot.services.utils.matcher import lcs_ratio, difflib_ratio, bounded_ratio
+        # transpositions and edits that lcs_ratio scores higher than difflib, around the thresholds of 0.9 to 1
+        names = self.NAMES + [
+            ("fullmetal alchemist brotherhood", "fullmetla alhcemist brotherhood"),
+            ("violet evergarden", "violet vregarden"),
+            ("violet evergarden", "vioelt veergarden"),
+            ("kishin douji zenki", "kishin douji ekzi"),
+            ("yuuko sera", "yuuko sear"),
+            ("yutaka nakamura", "yutaka nakamrua"),
+            ("hiroyuki imaishi", "hiroyuki imaishi 2"),
+        ]
+        self.assertGreater(lcs_ratio("fullmetalalchemistbrotherhood", "fullmetlaalhcemistbrotherhood"), 0.93)
+        self.assertLess(difflib_ratio("fullmetalalchemistbrotherhood", "fullmetlaalhcemistbrotherhood"), 0.9)
+        for service_class in (ANNArtistInfoService, MALCopyrightInfoService, BangumiCopyrightInfoService,
+                              GoogleKGSArtistInfoService, GoogleKGSCopyrightInfoService, AtwikiInfoService,
+                              ASDBCopyrightInfoService):
+            service = service_class()
+            for original, target in names:
+                service.matcher = difflib_ratio
+                expected = service._get_diff_ratio(original, target)
+                service.matcher = bounded_ratio
+                ratio = service._get_diff_ratio(original, target)
+                for weight in (0, service.MAX_ITEM_WEIGHT):
+                    self.assertEqual(ratio + weight >= service.MIN_RATIO, expected + weight >= service.MIN_RATIO,
+                                     msg="{} {} {}".format(service_class.__name__, original, target))
+                if ratio + service.MAX_ITEM_WEIGHT >= service.MIN_RATIO:
+                    self.assertEqual(ratio, expected)
+
+
+class TestTokenBucketRateLimiter(TestCase):
+
+    def test_reserve(self):
+        from bot.services.utils.ratelimit import TokenBucketRateLimiter
+        limiter = TokenBucketRateLimiter("example.com", 1, burst=2)
+        self.assertEqual(limiter.reserve(), 0)
+        self.assertEqual(limiter.reserve(), 0)
+        self.assertAlmostEqual(limiter.reserve(), 1, delta=0.1)
+        self.assertAlmostEqual(TokenBucketRateLimiter("example.com", 1, burst=2).reserve(), 2, delta=0.1)
+        self.assertEqual(TokenBucketRateLimiter("example.org", 1, burst=2).reserve(), 0)
+
+    def test_reserve_queries(self):
+        from bot.models import RateLimitBucket
+        from bot.services.utils.ratelimit import TokenBucketRateLimiter
+        limiter = TokenBucketRateLimiter("example.net", 1, burst=2)
+        limiter.reserve()
+        with self.assertNumQueries(1):
+            self.assertEqual(limiter.reserve(), 0)
+        RateLimitBucket.objects.all().delete()
+        self.assertEqual(limiter.reserve(), 0)
+        self.assertEqual(RateLimitBucket.objects.get(host="example.net").tokens, 1)
+
+
+class TestScrapers(SimpleTestCase):
+
+    @staticmethod
+    def load_fixture(name):
+        import os
+        response = gen_response('')
+        with open(os.path.join(os.path.dirname(__file__), 'fixtures', 'pages', name), 'rb') as f:
+            response._content = f.read()
+        return response
+
+    def test_ann(self):
+        from bot.services.info_service import ANNArtistInfoService
+        service = ANNArtistInfoService()
+        self.assertEqual(service._generate_search_results(self.load_fixture('ann_search.html')),
+                         [{'description': '(animator)', 'ann_pid': 61765, 'name_en': 'Yuuko Sera'},
+                          {'ann_pid': 61766, 'name_en': 'Yuuko Seraphim'},
+                          {'ann_pid': 70001, 'name_en': 'Yuko Sera'}])
+        self.assertEqual(service._generate_entity_info(self.load_fixture('ann_people.html')), {'name_ja': '世良悠子'})
+
+    def test_mal(self):
+        from bot.services.info_service import MALCopyrightInfoService
+        service = MALCopyrightInfoService()
+        self.assertEqual(service._generate_search_results(self.load_fixture('mal_search.html')),
+                         [{'mal_aid': 1573, 'name_en': 'Kishin Douji Zenki'},
+                          {'mal_aid': 1574, 'name_en': 'Kishin Douji Zenki Gaiden: Anki Kitan'}])
+        self.assertEqual(service._generate_entity_info(self.load_fixture('mal_anime.html')), {'name_ja': '鬼神童子ZENKI'})
+
+    def test_atwiki(self):
+        from bot.services.info_service import AtwikiInfoService
+        self.assertEqual(list(AtwikiInfoService()._generate_search_results(self.load_fixture('atwiki_search.html'))),
+                         [{'sakuga_wiki_id': '1203', 'name_ja': '高瀬健一'},
+                          {'anime_wiki_id': '257', 'name_ja': '高瀬健一'},
+                          {'sakuga_wiki_id': '99', 'name_ja': '高瀬健二'}])
+
+    def test_asdb(self):
+        from bot.services.info_service import ASDBCopyrightInfoService
+        self.assertEqual(ASDBCopyrightInfoService()._generate_search_results(self.load_fixture('asdb_search.html')),
+                         [{'anime_staff_database_link': 'http://seesaawiki.jp/w/radioi_34/d/%c5%d2%a5%b1%a5%b0%a5%eb%a5%a4',
+                           'name_ja': '賭ケグルイ'},
+                          {'anime_staff_database_link': 'http://seesaawiki.jp/w/radioi_34/d/'
+                                                        '%c5%d2%a5%b1%a5%b0%a5%eb%a5%a4%a1%df%a1%df',
+                           'name_ja': '賭ケグルイ××'}])
+
+
+def gen_kgs_response(*ids):
+    import json
+    return gen_response(json.dumps({"itemListElement": [
+        {"result": {"@id": "kg:/m/{}".format(x),
+                    "@type": ["Thing"],
+                    "name": [{"@language": "en", "@value": "name {}".format(x)}],
+                    "description": [{"@language": "en", "@value": "anime {}".format(x)}]},
+         "resultScore": 100} for x in ids]}))
+
+
+@override_settings(INFO_SERVICE_CACHE=False, INFO_SERVICE_RATE_LIMIT=False)
+class TestGoogleKGSBatching(SimpleTestCase):
+
+    def setUp(self):
+        from bot.services.info_service import GoogleKGSCopyrightInfoService
+        GoogleKGSCopyrightInfoService.ENTITY_CACHE.clear()
+
+    def test_get_entities_info(self):
+        from bot.services.info_service import GoogleKGSCopyrightInfoService
+        service = GoogleKGSCopyrightInfoService()
+        service.session = FakeSession(gen_kgs_response(1), gen_kgs_response(2, 3))
+        self.assertEqual(service.get_info("name 1"), {'kgs_url': 'http://g.co/kg/m/1',
+                                                      'description': 'anime 1',
+                                                      'name_en': 'name 1'})
+        entities = service.get_entities_info('http://g.co/kg/m/1', 'http://g.co/kg/m/2', 'http://g.co/kg/m/3',
+                                             'http://g.co/kg/m/2')
+        self.assertEqual(sorted(entities), ['http://g.co/kg/m/1', 'http://g.co/kg/m/2', 'http://g.co/kg/m/3'])
+        self.assertEqual(service.session.calls[1][1]['params']['ids'], ['/m/2', '/m/3'])
+        self.assertEqual(service.get_info("other name", kgs_url='http://g.co/kg/m/3')['name_en'], 'name 3')
+        self.assertEqual(len(service.session.calls), 2)
+
+    def test_entity_cache_expired(self):
+        from bot.services.info_service import GoogleKGSCopyrightInfoService
+        service = GoogleKGSCopyrightInfoService()
+        service.session = FakeSession(gen_kgs_response(1), gen_kgs_response(1))
+        service.get_entities_info('http://g.co/kg/m/1')
+        service.get_entities_info('http://g.co/kg/m/1')
+        self.assertEqual(len(service.session.calls), 1)
+        for key, (expire_time, info_dict) in list(service.ENTITY_CACHE.items()):
+            service.ENTITY_CACHE[key] = (now() - timedelta(seconds=1), info_dict)
+        self.assertEqual(list(service.get_entities_info('http://g.co/kg/m/1')), ['http://g.co/kg/m/1'])
+        self.assertEqual(len(service.session.calls), 2)
+
+    def test_entity_cache_threads(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from bot.services.utils.cache import LRUCache
+        from bot.services.info_service import GoogleKGSCopyrightInfoService
+        service = GoogleKGSCopyrightInfoService()
+        service.ENTITY_CACHE = LRUCache(50)
+
+        def worker(n):
+            for i in range(200):
+                kgs_url = 'http://g.co/kg/m/{}'.format((n * 200 + i) % 80)
+                service._set_cached_entity({'kgs_url': kgs_url})
+                service._get_cached_entity(kgs_url)
+
+        with ThreadPoolExecutor(8) as executor:
+            list(executor.map(worker, range(8)))
+        self.assertEqual(len(service.ENTITY_CACHE), 50)
+
+    def test_dedupe_searches(self):
+        import asyncio
+        from bot.services.info_service import AsyncInfoService, GoogleKGSCopyrightInfoService
+        session = FakeSession(gen_kgs_response(1))
+
+        async def search():
+            services = [AsyncInfoService(GoogleKGSCopyrightInfoService) for _ in range(3)]
+            for service in services:
+                service.service.session = session
+            return await asyncio.gather(*[x.get_info("name 1") for x in services])
+
+        self.assertEqual([x['kgs_url'] for x in asyncio.run(search())], ['http://g.co/kg/m/1'] * 3)
+        self.assertEqual(len(session.calls), 1)
+
+
+@override_settings(INFO_SERVICE_CACHE=False, INFO_SERVICE_RATE_LIMIT=False)
+class TestAsyncInfoService(SimpleTestCase):
+
+    def test_get_info(self):
+        import asyncio
+        import requests
+        from bot.services.info_service import AsyncInfoService, ANNArtistInfoService
+        service = AsyncInfoService(ANNArtistInfoService)
+        service.BACKOFF_BASE = 0
+        service.service.session = FakeSession(requests.ConnectionError(),
+                                              TestScrapers.load_fixture('ann_search.html'),
+                                              TestScrapers.load_fixture('ann_people.html'))
+        self.assertEqual(asyncio.run(service.get_info("yuuko sera")),
+                         {'description': '(animator)', 'ann_pid': 61765, 'name_en': 'Yuuko Sera', 'name_ja': '世良悠子'})
+        self.assertEqual(len(service.service.session.calls), 3)
+        self.assertFalse(service.failed)
+
+    def test_run_async(self):
+        import asyncio
+        import threading
+        from unittest.mock import patch
+        from django.db import connections
+        from django.db.backends.base.base import BaseDatabaseWrapper
+        from bot.services.info_service import run_async
+        closed = list()
+
+        def work():
+            return threading.current_thread(), connections['default']
+
+        async def main():
+            loop = asyncio.get_running_loop()
+            return await asyncio.gather(*[loop.run_in_executor(None, work) for _ in range(4)])
+
+        def close(connection):
+            connection.validate_thread_sharing()
+            closed.append(connection)
+
+        with patch.object(BaseDatabaseWrapper, 'close', close):
+            results = run_async(main(), max_workers=2)
+        threads, used = zip(*results)
+        self.assertFalse(any(x.is_alive() for x in threads))
+        self.assertTrue(set(used) <= set(closed))
+        self.assertLessEqual(len(closed), 2)
+        self.assertNotIn(connections['default'], closed)
+
+    def test_get_info_failed(self):
+        import asyncio
+        import requests
+        from bot.services.info_service import AsyncInfoService, ANNArtistInfoService
+        service = AsyncInfoService(ANNArtistInfoService)
+        service.BACKOFF_BASE = 0
+        service.service.session = FakeSession(*[requests.ConnectionError()] * service.MAX_ATTEMPTS)
+        self.assertEqual(asyncio.run(service.get_info("yuuko sera")), dict())
+        self.assertTrue(service.failed)
+
+
+@override_settings(INFO_SERVICE_CACHE=False, INFO_SERVICE_RATE_LIMIT=False)
 class TestInfoServices(SimpleTestCase):
 
     def test_ann(self):
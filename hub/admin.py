@@ -16,7 +16,7 @@ from django.utils.html import format_html, escape
 from django.utils.translation import gettext_lazy as _
 
 from bot.tasks import update_tags_info_task, update_posts_task, post_weibo_task
-from hub.models import Post, Tag, TagSnapshot, Attribute, Node, TagSnapshotNodeRelation, Uploader
+from hub.models import Post, Tag, TagSnapshot, Attribute, Node, TagSnapshotNodeRelation, Uploader, AttributeRegistry
 
 
 def object_link(field, short_description=None, admin_order_field=None):
@@ -109,8 +109,7 @@ class TagAdmin(admin.ModelAdmin):
             fieldsets.append(
                 ('Tag Detail', {
                     'classes': ('wide', 'extrapretty'),
-                    'fields': ['_detail__%s' % x.code for x in
-                               Attribute.objects.filter(related_types__contains=[obj.type]).order_by('order')],
+                    'fields': ['_detail__%s' % x.code for x in AttributeRegistry.filter(type=obj.type)],
                 }))
 
         return fieldsets
@@ -148,7 +147,7 @@ class TagAdmin(admin.ModelAdmin):
         # MediaDefiningClass
         if obj:
             detail_attrs = dict()
-            for attr in Attribute.objects.filter(related_types__contains=[obj.type]):
+            for attr in AttributeRegistry.filter(type=obj.type):
                 widget = forms.Textarea if attr.code == "description" else attr.form_field_class.widget
                 detail_attrs['_detail__%s' % attr.code] = attr.form_field_class(label=attr.code,
                                                                                 required=False,
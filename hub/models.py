@@ -1,20 +1,24 @@
 import collections
+import copy
 import json
+import threading
 from datetime import datetime, date, time
+from time import monotonic
 
 from django import forms
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import User
 from django.contrib.postgres.fields import ArrayField
 from django.db import models, transaction
-from django.db.models import JSONField
+from django.db.models import JSONField, OuterRef, Subquery
 from django.utils.dateparse import parse_date, parse_time, parse_datetime
 
 from bot.constants import SAKUGABOORU_DATA_URL, SAKUGABOORU_PREVIEW_URL, SAKUGABOORU_PREVIEW_EXT, SAKUGABOORU_POST, \
     ANIMATED_MEDIA_EXTS
 from hub.fields import HashField, hash_it, LengthField
 from hub.utils.JSONEncoder import DjangoJSONEncoder
-from sakugabot.settings import NEW_COMMIT_SECONDS
+from sakugabot.settings import NEW_COMMIT_SECONDS, ATTRIBUTE_REGISTRY_CHECK_SECONDS, TAG_SNAPSHOT_DELTA, \
+    TAG_SNAPSHOT_KEYFRAME_INTERVAL
 
 
 class Uploader(models.Model):
@@ -56,6 +60,10 @@ class Tag(models.Model):
     _detail = JSONField(encoder=DjangoJSONEncoder, default=dict, blank=True)
     order_of_keys = ArrayField(models.CharField(max_length=255), default=list, blank=True)
 
+    latest_snapshot = models.ForeignKey("hub.TagSnapshot", related_name="+", default=None, null=True, blank=True,
+                                        editable=False, on_delete=models.SET_NULL)
+    latest_snapshot_hash = models.CharField(max_length=40, default=None, null=True, blank=True, editable=False)
+
     @property
     def detail(self):
         return self._detail
@@ -67,10 +75,34 @@ class Tag(models.Model):
 
     @property
     def snapshot_latest(self):
-        try:
-            return self.snapshots.latest('update_time')
-        except TagSnapshot.DoesNotExist:
-            return None
+        return self.latest_snapshot
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        """
+        the latest snapshot is only written by _set_latest_snapshot, so that an outdated instance
+        or a new instance of an existing tag does not overwrite it.
+        """
+        values = [x for x in values if x[0].name not in ('latest_snapshot', 'latest_snapshot_hash')]
+        updated = super(Tag, self)._do_update(base_qs, using, pk_val, values, update_fields, forced_update)
+        self._latest_snapshot_outdated = updated and self._state.adding
+        return updated
+
+    def _set_latest_snapshot(self, snapshot):
+        self.latest_snapshot = snapshot
+        self.latest_snapshot_hash = getattr(snapshot, 'hash', None)
+        Tag.objects.filter(pk=self.pk).update(latest_snapshot=snapshot, latest_snapshot_hash=self.latest_snapshot_hash)
+
+    @classmethod
+    def refresh_latest_snapshots(cls, queryset=None):
+        """
+        Backfill latest_snapshot and latest_snapshot_hash from snapshots.
+        :param queryset: tags to refresh, all tags by default
+        :return: count of refreshed tags
+        """
+        latest = TagSnapshot.objects.filter(tag=OuterRef('pk')).order_by('-update_time')
+        return (cls.objects.all() if queryset is None else queryset).update(
+            latest_snapshot=Subquery(latest.values('pk')[:1]),
+            latest_snapshot_hash=Subquery(latest.values('hash')[:1]))
 
     @property
     def weibo_name(self):
@@ -100,7 +132,7 @@ class Tag(models.Model):
         return None
 
     def names(self):
-        name_codes = [x.code for x in Attribute.objects.filter(code__startswith='name')]
+        name_codes = [x.code for x in AttributeRegistry.filter(prefix='name')]
         return dict(filter(lambda x: x[0] in name_codes, list(self._detail.items())))
 
     @property
@@ -125,7 +157,7 @@ class Tag(models.Model):
 
     def _gen_hash_if_changed(self):
         hash = hash_it(json.dumps(self.ordered_detail, cls=DjangoJSONEncoder))
-        if hash == getattr(self.snapshot_latest, 'hash', None):
+        if hash == self.latest_snapshot_hash:
             return None
         return hash
 
@@ -167,17 +199,20 @@ class Tag(models.Model):
             seconds_since_last_create = (datetime.utcnow().timestamp() - snapshot.create_time.timestamp())
             if not ((snapshot.raw_user == user and seconds_since_last_create <= NEW_COMMIT_SECONDS) or
                     snapshot.raw_user is user is None):
+                parent = snapshot
                 snapshot = TagSnapshot(tag=self, _user=user, hash=hash,
-                                       note=self._gen_snapshot_note(snapshot.content, content, hash))
+                                       note=self._gen_snapshot_note(parent.content, content, hash))
+                snapshot.set_parent(parent)
             else:
-                query = self.snapshots.order_by('-update_time')
+                query = TagSnapshot.load_contents(*self.snapshots.order_by('-update_time')[:2])
                 if len(query) > 1:
                     if query[1].hash == hash:
                         snapshot.delete()
-                        return
+                        return query[1]
                     snapshot.note = self._gen_snapshot_note(query[1].content, content, hash)
                 snapshot.hash = hash
         snapshot.save(content=content)
+        return snapshot
 
     @staticmethod
     def gen_order_of_keys(order, keys):
@@ -193,10 +228,13 @@ class Tag(models.Model):
         user = kwargs.pop('editor', None)
         self.refresh_order()
 
+        self._latest_snapshot_outdated = False
         super(Tag, self).save(*args, **kwargs)
+        if self._latest_snapshot_outdated:
+            self.refresh_from_db(fields=['latest_snapshot', 'latest_snapshot_hash'])
         hash = self._gen_hash_if_changed()
         if hash:
-            self._create_snapshot(user, hash, self.ordered_detail)
+            self._set_latest_snapshot(self._create_snapshot(user, hash, self.ordered_detail))
 
     class Meta:
         indexes = [
@@ -281,12 +319,92 @@ class Attribute(models.Model):
 
     @staticmethod
     def get_attr_by_code(code, type=None):
-        res = Attribute.objects.filter(code=code)
-        if type:
-            res = res.filter(related_types__contains=[type])
-        if res:
-            return res[0]
-        return None
+        return AttributeRegistry.get(code, type)
+
+    def save(self, *args, **kwargs):
+        super(Attribute, self).save(*args, **kwargs)
+        AttributeVersion.bump()
+
+    def delete(self, *args, **kwargs):
+        res = super(Attribute, self).delete(*args, **kwargs)
+        AttributeVersion.bump()
+        return res
+
+
+class AttributeVersion(models.Model):
+    """
+    version of Attributes, bumped on every save or delete of Attribute so that all processes reload their registry.
+    """
+    version = models.PositiveIntegerField(default=0)
+
+    PK = 1
+
+    @classmethod
+    def get_version(cls):
+        return cls.objects.filter(pk=cls.PK).values_list('version', flat=True).first() or 0
+
+    @classmethod
+    def bump(cls):
+        if not cls.objects.filter(pk=cls.PK).update(version=models.F('version') + 1):
+            cls.objects.get_or_create(pk=cls.PK, defaults={'version': 1})
+        AttributeRegistry.clear()
+
+
+class AttributeRegistry(object):
+    """
+    process-local Attributes by code, ordered by order.
+    AttributeVersion is checked at most once per ATTRIBUTE_REGISTRY_CHECK_SECONDS and all Attributes are reloaded
+    when it has changed. get and filter return copies, so the shared instances can't be changed by callers.
+    """
+    _attributes = None
+    _version = None
+    _check_time = 0
+    _lock = threading.Lock()
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._attributes = None
+
+    @classmethod
+    def _get_attributes(cls):
+        with cls._lock:
+            current = monotonic()
+            if cls._attributes is not None and current - cls._check_time < ATTRIBUTE_REGISTRY_CHECK_SECONDS:
+                return cls._attributes
+            version = AttributeVersion.get_version()
+            if cls._attributes is None or version != cls._version:
+                cls._attributes = collections.OrderedDict((x.code, x) for x in Attribute.objects.order_by('order'))
+                cls._version = version
+            cls._check_time = current
+            return cls._attributes
+
+    @classmethod
+    def get(cls, code, type=None):
+        attr = cls._get_attributes().get(code, None)
+        if attr is None or (type and type not in attr.related_types):
+            return None
+        return copy.deepcopy(attr)
+
+    @classmethod
+    def filter(cls, type=None, prefix=None):
+        """
+        :param type: related type of Tag
+        :param prefix: prefix of code
+        :return: list of Attribute ordered by order
+        """
+        return [copy.deepcopy(x) for x in cls._get_attributes().values() if
+                (type is None or type in x.related_types) and (prefix is None or x.code.startswith(prefix))]
+
+
+class TagSnapshotQuerySet(models.QuerySet):
+
+    @transaction.atomic
+    def delete(self):
+        tag_pks = set(self.values_list('tag_id', flat=True))
+        result = super(TagSnapshotQuerySet, self).delete()
+        Tag.refresh_latest_snapshots(Tag.objects.filter(pk__in=tag_pks))
+        return result
 
 
 class TagSnapshot(models.Model):
@@ -297,41 +415,109 @@ class TagSnapshot(models.Model):
     _user = models.ForeignKey(get_user_model(), blank=True, null=True, default=None, on_delete=models.PROTECT)
     create_time = models.DateTimeField(auto_now_add=True)
 
+    # delta snapshots only store keys added or changed since parent, keyframes have no parent
+    parent = models.ForeignKey("self", related_name="children", default=None, null=True, blank=True,
+                               editable=False, on_delete=models.RESTRICT)
+    depth = models.PositiveSmallIntegerField(default=0, editable=False)
+    order_of_keys = ArrayField(models.CharField(max_length=255), default=list, blank=True, editable=False)
+
+    # deleting snapshots refreshes the latest snapshot of their tags, except on cascade from deleting tags
+    objects = TagSnapshotQuerySet.as_manager()
+
     def save(self, *args, **kwargs):
         content = kwargs.pop('content', None)
+        if content is not None and self.parent_id is not None:
+            self.order_of_keys = list(content.keys())
         super(TagSnapshot, self).save(*args, **kwargs)
         if content is not None:
             self.save_content(content)
 
+    @transaction.atomic
+    def delete(self, *args, **kwargs):
+        result = super(TagSnapshot, self).delete(*args, **kwargs)
+        Tag.refresh_latest_snapshots(Tag.objects.filter(pk=self.tag_id))
+        return result
+
+    def set_parent(self, parent):
+        """
+        Store the snapshot as a delta of parent when delta snapshots are enabled,
+        a keyframe is stored every TAG_SNAPSHOT_KEYFRAME_INTERVAL snapshots.
+        :param parent: previous TagSnapshot of the tag
+        """
+        if TAG_SNAPSHOT_DELTA and parent is not None and parent.depth + 1 < TAG_SNAPSHOT_KEYFRAME_INTERVAL:
+            self.parent = parent
+            self.depth = parent.depth + 1
+        else:
+            self.parent = None
+            self.depth = 0
+
     @property
     def content(self):
-        d = collections.OrderedDict()
-        for node in self.nodes.order_by("tagsnapshotnoderelation__order"):
-            d[node.attribute.code] = node.node_value
-        return d
+        if getattr(self, '_content', None) is None:
+            TagSnapshot.load_contents(self)
+        return collections.OrderedDict(self._content)
+
+    @staticmethod
+    def load_contents(*snapshots):
+        """
+        Load ordered contents of snapshots and cache them on the instances.
+        Parents of delta snapshots are fetched level by level, so the count of queries is bounded by
+        TAG_SNAPSHOT_KEYFRAME_INTERVAL, and all nodes are fetched with one query.
+        :param snapshots: TagSnapshot instances
+        :return: list of snapshots
+        """
+        loaded = {x.pk: x for x in snapshots}
+        pending = snapshots
+        while True:
+            parent_ids = {x.parent_id for x in pending if x.parent_id is not None and x.parent_id not in loaded}
+            if not parent_ids:
+                break
+            pending = list(TagSnapshot.objects.filter(pk__in=parent_ids).only('id', 'parent', 'order_of_keys'))
+            loaded.update((x.pk, x) for x in pending)
+
+        nodes = {pk: collections.OrderedDict() for pk in loaded}
+        relations = TagSnapshotNodeRelation.objects.filter(tag_snapshot__in=nodes.keys()).select_related(
+            'node__attribute').order_by('tag_snapshot', 'order')
+        for relation in relations:
+            nodes[relation.tag_snapshot_id][relation.node.attribute.code] = relation.node.node_value
+
+        contents = dict()
+
+        def build(pk):
+            if pk not in contents:
+                snapshot = loaded[pk]
+                if snapshot.parent_id is None:
+                    contents[pk] = nodes[pk]
+                else:
+                    parent_content = build(snapshot.parent_id)
+                    contents[pk] = collections.OrderedDict(
+                        (k, nodes[pk][k] if k in nodes[pk] else parent_content[k]) for k in snapshot.order_of_keys)
+            return contents[pk]
+
+        for snapshot in snapshots:
+            snapshot._content = build(snapshot.pk)
+        return list(snapshots)
 
     def save_content(self, content):
-        nodes = list()
-        for i, (key, value) in enumerate(content.items()):
+        if self.parent_id is not None:
+            if self.order_of_keys != list(content.keys()):
+                self.order_of_keys = list(content.keys())
+                TagSnapshot.objects.filter(pk=self.pk).update(order_of_keys=self.order_of_keys)
+            parent_content = self.parent.content
+            content = collections.OrderedDict((k, v) for k, v in content.items()
+                                              if k not in parent_content or parent_content[k] != v)
+        values = list()
+        for key, value in content.items():
             attribute = Attribute.get_attr_by_code(key)
             if not attribute:
                 raise AttributeError("Attribute {} does not exist.".format(key))
-            try:
-                obj_value = attribute.serialize_value(value)
-                hash_value = hash_it(obj_value)
-                node = Node.objects.get(attribute=attribute,
-                                        hash=hash_value,
-                                        length=len(obj_value))
-            except Node.DoesNotExist:
-                node = Node.create(attribute=attribute,
-                                   value=value)
-
-            nodes.append(TagSnapshotNodeRelation.objects.update_or_create(tag_snapshot=self,
-                                                                          node=node,
-                                                                          defaults={
-                                                                              'order': i
-                                                                          })[0])
-        TagSnapshotNodeRelation.objects.filter(tag_snapshot=self).exclude(id__in=[o.id for o in nodes]).delete()
+            values.append((attribute, attribute.serialize_value(value)))
+
+        nodes = Node.get_or_create_many(values)
+        TagSnapshotNodeRelation.objects.filter(tag_snapshot=self).delete()
+        TagSnapshotNodeRelation.objects.bulk_create(
+            [TagSnapshotNodeRelation(tag_snapshot=self, node=node, order=i) for i, node in enumerate(nodes)])
+        self._content = None
         # remove useless node
 
     @property
@@ -391,6 +577,29 @@ class Node(models.Model):
         node.save()
         return node
 
+    @classmethod
+    def get_or_create_many(cls, values):
+        """
+        :param values: list of (attribute, serialized value)
+        :return: list of Node in the same order as values
+        """
+        keys = [(attribute.pk, hash_it(value), len(value)) for attribute, value in values]
+
+        def get_nodes(ks):
+            return {(x.attribute_id, x.hash, x.length): x for x in
+                    cls.objects.filter(hash__in={k[1] for k in ks}) if
+                    (x.attribute_id, x.hash, x.length) in ks}
+
+        nodes = get_nodes(set(keys))
+        missing = {k: cls(attribute=attribute, _value=value) for k, (attribute, value) in zip(keys, values)
+                   if k not in nodes}
+        if missing:
+            cls.objects.bulk_create(missing.values(), ignore_conflicts=True)
+            nodes.update(get_nodes(set(missing.keys())))
+        for k, (attribute, _) in zip(keys, values):
+            nodes[k].attribute = attribute
+        return [nodes[k] for k in keys]
+
     class Meta:
         unique_together = ('attribute', 'hash', 'length')
 
@@ -428,6 +637,7 @@ class Post(models.Model):
 
     uploader = models.ForeignKey("hub.Uploader", on_delete=models.SET_NULL, default=None, null=True);
 
+    fingerprint = models.CharField(max_length=40, default='', blank=True, editable=False)
     update_time = models.DateTimeField(auto_now=True)
 
     @property
@@ -1,3 +1,248 @@
+from unittest.mock import patch
+
+from django.db.models import F
 from django.test import TestCase
 
-# Create your tests here.
+from hub.models import Attribute, AttributeRegistry, AttributeVersion, Tag
+
+
+class TestAttributeRegistry(TestCase):
+
+    def setUp(self):
+        AttributeRegistry.clear()
+        Attribute.objects.create(code="name_ja", type=Attribute.STRING, related_types=[Tag.ARTIST, Tag.COPYRIGHT])
+        Attribute.objects.create(code="ann_pid", type=Attribute.INTEGER, related_types=[Tag.ARTIST])
+
+    def test_get(self):
+        self.assertEqual(AttributeRegistry.get("name_ja").code, "name_ja")
+        with self.assertNumQueries(0):
+            self.assertEqual(Attribute.get_attr_by_code("ann_pid", Tag.ARTIST).type, Attribute.INTEGER)
+            self.assertIsNone(Attribute.get_attr_by_code("ann_pid", Tag.COPYRIGHT))
+            self.assertIsNone(AttributeRegistry.get("unknown"))
+            self.assertEqual([x.code for x in AttributeRegistry.filter(type=Tag.COPYRIGHT)], ["name_ja"])
+            self.assertEqual([x.code for x in AttributeRegistry.filter(prefix="name")], ["name_ja"])
+
+    def test_copies(self):
+        AttributeRegistry.get("name_ja").name = "changed"
+        AttributeRegistry.filter(type=Tag.ARTIST)[1].related_types.append(Tag.COPYRIGHT)
+        self.assertIsNone(AttributeRegistry.get("name_ja").name)
+        self.assertIsNone(AttributeRegistry.get("ann_pid", Tag.COPYRIGHT))
+
+    def test_serialize_removed_attribute(self):
+        from types import SimpleNamespace
+        from api.serializers import DetailTagSerializer, DetailTagSnapshotSerializer
+        detail = {"name_ja": "name", "removed": 1}
+        serializer = DetailTagSerializer()
+        info_list = serializer.get_detail(SimpleNamespace(detail=detail, order_of_keys=["name_ja", "removed"]))
+        self.assertEqual([x['value'] for x in info_list], ["name"])
+        info_list = DetailTagSnapshotSerializer().get_content(SimpleNamespace(content=detail))
+        self.assertEqual([x['value'] for x in info_list], ["name"])
+
+    def test_version(self):
+        AttributeRegistry.get("name_ja")
+        Attribute.objects.create(code="name_zh", type=Attribute.STRING, related_types=[Tag.COPYRIGHT])
+        self.assertEqual(AttributeRegistry.get("name_zh").code, "name_zh")
+
+        # changed by another process
+        Attribute.objects.filter(code="name_zh").update(name="Chinese Name")
+        AttributeVersion.objects.update(version=F('version') + 1)
+        self.assertIsNone(AttributeRegistry.get("name_zh").name)
+        AttributeRegistry._check_time = 0
+        self.assertEqual(AttributeRegistry.get("name_zh").name, "Chinese Name")
+
+
+class TestTagSnapshot(TestCase):
+
+    def setUp(self):
+        AttributeRegistry.clear()
+        for i, code in enumerate(["name_ja", "name_en", "name_zh", "ann_pid"]):
+            Attribute.objects.create(code=code, order=i, related_types=[Tag.GENERAL],
+                                     type=Attribute.INTEGER if code == "ann_pid" else Attribute.STRING)
+        AttributeRegistry.get("name_ja")
+
+    def test_save_content(self):
+        from hub.models import Node, TagSnapshot, TagSnapshotNodeRelation
+        tag = Tag.objects.create(name="test_tag")
+        snapshot = TagSnapshot.objects.create(tag=tag, hash="hash")
+        content = {"name_ja": "テスト", "name_en": "test", "ann_pid": 1}
+        with self.assertNumQueries(5):
+            snapshot.save_content(content)
+        self.assertEqual(dict(snapshot.content), content)
+        self.assertEqual(Node.objects.count(), 3)
+
+        content = {"name_zh": "测试", "name_en": "test", "name_ja": "テスト"}
+        with self.assertNumQueries(5):
+            snapshot.save_content(content)
+        self.assertEqual(list(snapshot.content.items()), list(content.items()))
+        self.assertEqual(Node.objects.count(), 4)
+        self.assertEqual(TagSnapshotNodeRelation.objects.filter(tag_snapshot=snapshot).count(), 3)
+
+        snapshot = TagSnapshot.objects.create(tag=tag, hash="hash")
+        with self.assertNumQueries(3):
+            snapshot.save_content(content)
+        self.assertEqual(Node.objects.count(), 4)
+
+    def test_load_contents(self):
+        from hub.models import TagSnapshot
+        tag = Tag.objects.create(name="test_tag")
+        contents = [{"name_ja": "テスト", "ann_pid": 1}, {}, {"ann_pid": 2, "name_en": "test", "name_ja": "テスト"}]
+        for content in contents:
+            TagSnapshot.objects.create(tag=tag, hash="hash").save_content(content)
+
+        snapshots = list(TagSnapshot.objects.filter(tag=tag).exclude(note="Init").order_by('id'))
+        with self.assertNumQueries(1):
+            TagSnapshot.load_contents(*snapshots)
+            self.assertEqual([list(x.content.items()) for x in snapshots], [list(x.items()) for x in contents])
+
+        snapshot = snapshots[-1]
+        snapshot.content["name_zh"] = "测试"
+        snapshot.save_content({"name_en": "test"})
+        with self.assertNumQueries(1):
+            self.assertEqual(dict(snapshot.content), {"name_en": "test"})
+            self.assertEqual(dict(snapshot.content), {"name_en": "test"})
+
+
+class TestLatestSnapshot(TestCase):
+
+    def setUp(self):
+        AttributeRegistry.clear()
+        for i, code in enumerate(["name_ja", "name_en"]):
+            Attribute.objects.create(code=code, order=i, type=Attribute.STRING, related_types=[Tag.GENERAL])
+
+    def test_save(self):
+        from django.contrib.auth.models import User
+        from hub.models import TagSnapshot
+        user = User.objects.create(username="editor")
+        tag = Tag.objects.create(name="test_tag")
+        self.assertEqual(tag.snapshot_latest.note, "Init")
+
+        tag.detail = {"name_ja": "tesuto"}
+        tag.save(editor=user)
+        first = tag.snapshot_latest
+        self.assertEqual(Tag.objects.get(pk=tag.pk).latest_snapshot_id, first.id)
+        self.assertEqual(tag.latest_snapshot_hash, first.hash)
+
+        tag.detail = {"name_ja": "tesuto", "name_en": "test"}
+        tag.save()
+        second = tag.snapshot_latest
+        self.assertNotEqual(first.id, second.id)
+
+        tag = Tag.objects.select_related('latest_snapshot___user').get(pk=tag.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(tag.snapshot_latest.user_name, "System")
+        with self.assertNumQueries(3):  # savepoint, update, release
+            tag.save()
+
+        # amending by the same editor back to the previous content drops the new snapshot
+        tag.detail = {"name_ja": "tesuto"}
+        tag.save()
+        self.assertEqual(tag.snapshot_latest.id, first.id)
+        self.assertEqual(Tag.objects.get(pk=tag.pk).latest_snapshot_hash, first.hash)
+
+        # an outdated instance keeps the pointer written by another save
+        stale = Tag.objects.get(pk=tag.pk)
+        tag.detail = {"name_en": "test"}
+        tag.save()
+        self.assertNotEqual(tag.latest_snapshot_id, first.id)
+        stale.like_count = 1
+        stale.save()
+        self.assertEqual(Tag.objects.get(pk=tag.pk).latest_snapshot_id, tag.latest_snapshot_id)
+
+        # deleting the latest snapshot moves the pointer back
+        tag.latest_snapshot.delete()
+        self.assertEqual(Tag.objects.get(pk=tag.pk).latest_snapshot_id, first.id)
+        self.assertEqual(Tag.objects.get(pk=tag.pk).latest_snapshot_hash, first.hash)
+
+        Tag.objects.update(latest_snapshot=None, latest_snapshot_hash=None)
+        self.assertEqual(Tag.refresh_latest_snapshots(), 1)
+        self.assertEqual(Tag.objects.get(pk=tag.pk).latest_snapshot_id,
+                         TagSnapshot.objects.filter(tag=tag).latest('update_time').id)
+
+    def test_save_new_instance(self):
+        tag = Tag.objects.create(name="test_tag")
+        tag.detail = {"name_ja": "tesuto"}
+        tag.save()
+        latest_snapshot_id = tag.latest_snapshot_id
+
+        tag = Tag(name="test_tag", _detail={"name_ja": "tesuto"}, order_of_keys=["name_ja"])
+        tag.save()
+        self.assertEqual(tag.latest_snapshot_id, latest_snapshot_id)
+        self.assertEqual(Tag.objects.get(pk="test_tag").latest_snapshot_id, latest_snapshot_id)
+        self.assertEqual(tag.snapshots.count(), 1)
+
+    def test_delete_snapshots(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from django.contrib.auth.models import User
+        from hub.models import TagSnapshot
+        user = User.objects.create(username="editor")
+        tags = [Tag.objects.create(name="tag_{}".format(i)) for i in range(3)]
+        for tag in tags:
+            tag.detail = {"name_ja": "tesuto"}
+            tag.save(editor=user)
+
+        def count_refreshes(queries):
+            return len([x for x in queries if x['sql'].startswith('UPDATE "hub_tag" SET "latest_snapshot_id" = (')])
+
+        with CaptureQueriesContext(connection) as queries:
+            TagSnapshot.objects.filter(tag__in=tags[:2]).exclude(note="Init").delete()
+        self.assertEqual(count_refreshes(queries), 1)
+        self.assertEqual([x.latest_snapshot.note for x in Tag.objects.filter(pk__in=["tag_0", "tag_1"])],
+                         ["Init", "Init"])
+
+        with CaptureQueriesContext(connection) as queries:
+            tags[2].delete()
+        self.assertEqual(count_refreshes(queries), 0)
+        self.assertFalse(TagSnapshot.objects.filter(tag_id="tag_2").exists())
+
+
+
+class TestDeltaSnapshot(TestCase):
+
+    def setUp(self):
+        AttributeRegistry.clear()
+        for i, code in enumerate(["name_ja", "name_en", "name_zh"]):
+            Attribute.objects.create(code=code, order=i, type=Attribute.STRING, related_types=[Tag.GENERAL])
+
+    @patch("hub.models.TAG_SNAPSHOT_KEYFRAME_INTERVAL", 3)
+    @patch("hub.models.TAG_SNAPSHOT_DELTA", True)
+    def test_save(self):
+        from django.contrib.auth.models import User
+        from hub.models import TagSnapshot, TagSnapshotNodeRelation
+        users = [User.objects.create(username="editor_a"), User.objects.create(username="editor_b")]
+        tag = Tag.objects.create(name="test_tag")
+        details = [{"name_ja": "a", "name_en": "b"},
+                   {"name_ja": "a", "name_en": "c"},
+                   {"name_en": "c", "name_ja": "a", "name_zh": "d"},
+                   {"name_zh": "d"},
+                   {"name_zh": "e", "name_en": "f"}]
+        for i, detail in enumerate(details):
+            tag.detail = detail
+            tag.order_of_keys = list(detail.keys())
+            tag.save(editor=users[i % 2])
+
+        snapshots = list(TagSnapshot.objects.filter(tag=tag).exclude(note="Init").order_by('id'))
+        self.assertEqual([x.depth for x in snapshots], [1, 2, 0, 1, 2])
+        self.assertEqual([TagSnapshotNodeRelation.objects.filter(tag_snapshot=x).count() for x in snapshots],
+                         [2, 1, 3, 0, 2])
+
+        snapshots = list(TagSnapshot.objects.filter(tag=tag).exclude(note="Init").order_by('id'))
+        with self.assertNumQueries(2):
+            TagSnapshot.load_contents(*snapshots)
+        self.assertEqual([list(x.content.items()) for x in snapshots], [list(x.items()) for x in details])
+
+        # one query per level of ancestors, then one for the nodes
+        snapshot = TagSnapshot.objects.get(pk=snapshots[-1].pk)
+        with self.assertNumQueries(3):
+            self.assertEqual(list(snapshot.content.items()), list(details[-1].items()))
+
+        # amending the latest snapshot keeps it a delta of its parent
+        tag.detail = {"name_zh": "e", "name_en": "g"}
+        tag.order_of_keys = ["name_zh", "name_en"]
+        tag.save(editor=users[0])
+        snapshot = TagSnapshot.objects.get(pk=snapshots[-1].pk)
+        self.assertEqual(list(snapshot.content.items()), [("name_zh", "e"), ("name_en", "g")])
+        self.assertEqual(TagSnapshotNodeRelation.objects.filter(tag_snapshot=snapshot).count(), 2)
+
+        tag.delete()
+        self.assertFalse(TagSnapshot.objects.exists())
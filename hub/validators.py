@@ -3,7 +3,7 @@ import re
 from django.core.exceptions import ValidationError
 from django.utils.translation import gettext_lazy as _
 
-from hub.models import Attribute
+from hub.models import AttributeRegistry
 
 
 class TagDetailValidator(object):
@@ -13,7 +13,7 @@ class TagDetailValidator(object):
         if attributes:
             self.attributes = {attr.code: attr for attr in attributes}
         else:
-            self.attributes = {attr.code: attr for attr in Attribute.objects.all()}
+            self.attributes = {attr.code: attr for attr in AttributeRegistry.filter()}
 
     def __call__(self, value):
         for k, v in value.items():
@@ -159,6 +159,9 @@ USE_L10N = True
 USE_TZ = True
 
 NEW_COMMIT_SECONDS = 60 * 10
+ATTRIBUTE_REGISTRY_CHECK_SECONDS = 10
+TAG_SNAPSHOT_DELTA = False
+TAG_SNAPSHOT_KEYFRAME_INTERVAL = 10
 
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/2.0/howto/static-files/
@@ -189,6 +192,25 @@ WEIBO_GIF_WIDTH = 360
 
 TASK_TIME_LIMIT = 1200
 
+SAKUGABOORU_BACKFILL_WORKERS = 4
+SAKUGABOORU_REQUESTS_PER_SECOND = 2
+SAKUGABOORU_RESCAN_HOURS = 72
+SAKUGABOORU_RESCAN_INTERVAL = 60 * 30
+TAG_MIRROR_REFRESH_INTERVAL = 60 * 60 * 24
+
+INFO_SERVICE_CACHE = True
+INFO_SERVICE_RATE_LIMIT = True
+INFO_SERVICE_MATCHER = 'bot.services.utils.matcher.bounded_ratio'
+INFO_SERVICE_CONCURRENT_TAGS = 8
+INFO_SERVICE_MAX_WORKERS = 32
+INFO_SERVICE_CACHE_PURGE_DAYS = 7
+TAGS_INFO_CHUNK_SIZE = 20
+TAGS_INFO_CONCURRENCY = 4
+TAGS_INFO_STALE_DAYS = 30
+TAGS_INFO_RETRY_HOURS = 6
+TAGS_INFO_HOURLY_BUDGET = 300
+TAGS_INFO_REFRESH_INTERVAL = 60 * 60
+
 MAX_PENDING_HOURS = 72
 
 LOGIN_RATE_LIMIT = '10/1h'
@@ -0,0 +1,113 @@
+import argparse
+import os
+import timeit
+
+import django
+import regex
+import requests
+from bs4 import BeautifulSoup
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "sakugabot.settings")
+django.setup()
+from bot.services.info_service import ANNArtistInfoService, MALCopyrightInfoService, AtwikiInfoService, \
+    ASDBCopyrightInfoService
+from bot.constants import SAKUGAWIKI_URL_PATTERN, ANIMEWIKI_URL_PATTERN
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bot', 'fixtures', 'pages')
+
+
+def _ann_search(response):
+    info_list = list()
+    soup = BeautifulSoup(response.content, 'lxml')
+    for result in soup.find_all('a', href=regex.compile(r"/encyclopedia/people.php\?id=")):
+        info_dict = dict()
+        try:
+            description = result.i.get_text(strip=True)
+            result.i.clear()
+            if description:
+                info_dict["description"] = description
+        except AttributeError:
+            pass
+        info_dict.update({"ann_pid": int(regex.findall(r"\d+", result.get('href'))[0]),
+                          "name_en": result.get_text().strip()})
+        info_list.append(info_dict)
+    return info_list
+
+
+def _ann_people(response):
+    soup = BeautifulSoup(response.content, 'lxml')
+    title_block = soup.find(id="page-title")
+    title_block.h1.clear()
+    original_name = title_block.get_text(strip=True)
+    if not regex.match(regex.compile(r".*[\da-zA-Z]+.*"), original_name):
+        if original_name.count(' ') == 1:
+            original_name = original_name.replace(' ', '')
+    return {"name_ja": original_name} if original_name else dict()
+
+
+def _mal_search(response):
+    soup = BeautifulSoup(response.content, 'lxml', from_encoding='utf-8')
+    return [{"mal_aid": int(x['id'].replace('sinfo', '')), "name_en": x.strong.get_text()}
+            for x in soup.find_all('a', 'hoverinfo_trigger fw-b fl-l')]
+
+
+def _mal_anime(response):
+    soup = BeautifulSoup(response.content, 'lxml', from_encoding='utf-8')
+    title_tag = soup.find("span", text='Japanese:')
+    original_name = title_tag.parent.get_text(strip=True).replace("Japanese:", "") if title_tag else ""
+    return {"name_ja": original_name} if original_name else dict()
+
+
+def _atwiki_search(response):
+    info_list = list()
+    soup = BeautifulSoup(response.content, 'lxml')
+    for result in soup.find_all('a', 'atwiki_search_title'):
+        for code, pattern in (('sakuga_wiki_id', SAKUGAWIKI_URL_PATTERN), ('anime_wiki_id', ANIMEWIKI_URL_PATTERN)):
+            ids = regex.compile(pattern).findall(result['href'])
+            if len(ids) == 1:
+                info_list.append({code: ids[0], 'name_ja': result.get_text().split('-')[-1].strip()})
+    return info_list
+
+
+def _asdb_search(response):
+    soup = BeautifulSoup(response.content, 'lxml', from_encoding='EUC-JP')
+    return [{"anime_staff_database_link": x.a['href'], "name_ja": x.a.get_text(strip=True)}
+            for x in soup.find_all('h3', 'keyword')]
+
+
+# (fixture, BeautifulSoup parser before lxml, current parser)
+CASES = (
+    ('ann_search.html', _ann_search, ANNArtistInfoService()._generate_search_results),
+    ('ann_people.html', _ann_people, ANNArtistInfoService()._generate_entity_info),
+    ('mal_search.html', _mal_search, MALCopyrightInfoService()._generate_search_results),
+    ('mal_anime.html', _mal_anime, MALCopyrightInfoService()._generate_entity_info),
+    ('atwiki_search.html', _atwiki_search, lambda x: list(AtwikiInfoService()._generate_search_results(x))),
+    ('asdb_search.html', _asdb_search, ASDBCopyrightInfoService()._generate_search_results),
+)
+
+
+def load_fixture(name):
+    response = requests.models.Response()
+    response.status_code = 200
+    with open(os.path.join(FIXTURE_DIR, name), 'rb') as f:
+        response._content = f.read()
+    return response
+
+
+def benchmark(number):
+    for name, legacy, current in CASES:
+        response = load_fixture(name)
+        if legacy(response) != current(response):
+            print("{}: results differ, {} != {}".format(name, legacy(response), current(response)))
+        legacy_time = timeit.timeit(lambda: legacy(response), number=number) / number * 1000
+        current_time = timeit.timeit(lambda: current(response), number=number) / number * 1000
+        print("{:<20} bs4: {:8.3f}ms  lxml: {:8.3f}ms  x{:.1f}".format(name,
+                                                                     legacy_time,
+                                                                     current_time,
+                                                                     legacy_time / current_time))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare parse time of info service scrapers on fixture pages.')
+    parser.add_argument('-n', '--number', type=int, default=50, help='runs per page')
+    benchmark(parser.parse_args().number)
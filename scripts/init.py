@@ -4,7 +4,6 @@ import os
 from datetime import datetime
 
 import django
-import regex
 from pytz import utc
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "sakugabot.settings")
@@ -12,6 +11,7 @@ django.setup()
 from scripts.attributes import META_ATTRIBUTES
 from hub.models import Attribute, Tag, Uploader, Post
 from bot.models import Credential, Weibo
+from bot.services.utils.normalize import remove_ja_name_space
 
 
 def init_attributes():
@@ -28,13 +28,7 @@ ABANDONED_TAGS_E = []
 
 
 def _remove_space(name):
-    if not name:
-        return name
-    pattern = regex.compile(r".*[\da-zA-Z]+.*")
-    if not regex.match(pattern, name):
-        if name.count(' ') == 1:
-            return name.replace(' ', '')
-    return name
+    return remove_ja_name_space(name)
 
 
 def import_tags(tag_list):
@@ -160,7 +154,11 @@ def delete_existing_data():
 
 
 parser = argparse.ArgumentParser(description='Init Data')
+parser.add_argument('--refresh-latest-snapshots', action='store_true',
+                    help='backfill the latest snapshot of existing tags')
 
 if __name__ == "__main__":
     args = parser.parse_args()
     init_attributes()
+    if args.refresh_latest_snapshots:
+        print("Latest Snapshots Refreshed: {}".format(Tag.refresh_latest_snapshots()))